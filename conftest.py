@@ -0,0 +1,35 @@
+"""Shared test fixtures: synthetic PS1-like skycell images and files."""
+
+import numpy as np
+import pytest
+
+
+def syntheticSkycell(shape, seed=0):
+    """Returns a PS1-like float32 skycell image: heavy tailed sky noise, some stars, and a nan border."""
+    rng = np.random.default_rng(seed)
+    imgData = (rng.standard_t(3, size=shape)*5).astype(np.float32)
+    ys = rng.integers(0, shape[0], 200)
+    xs = rng.integers(0, shape[1], 200)
+    imgData[ys, xs] = rng.uniform(1e3, 1e5, 200)
+    imgData[:shape[0]//20, :] = np.nan
+    imgData[:, :shape[1]//30] = np.nan
+    return imgData
+
+
+@pytest.fixture
+def skycellImage():
+    """Makes synthetic skycell images, skycellImage(shape, seed=0)."""
+    return syntheticSkycell
+
+
+@pytest.fixture
+def skycellFile(tmp_path):
+    """Writes a skycell FITS file (image in the first extension) into tmp_path, skycellFile(name, imgData),
+    returning its path."""
+    from astropy.io import fits
+
+    def write(name, imgData):
+        filename = str(tmp_path / name)
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(imgData)]).writeto(filename)
+        return filename
+    return write
@@ -8,23 +8,82 @@ C. Brasseur, took out database queries 2016 July 1
 import sys, subprocess, os
 import numexpr as ne
 import numpy as np
-try:
-        import astropy.io.fits as pyfits
-except ImportError:
-        import pyfits
+from concurrent.futures import ThreadPoolExecutor
 
 # pixel scale is 0.25 arcsec
 pixscale = 0.25
 
-# read table of rings info from table in first extension of FITS file
+# table of rings info, read on first use from the table in first extension of ps1grid.fits
+# (or from a catalog compiled by psCatalog.py, see loadGrid)
 gridfits = os.path.join(os.path.split(os.path.realpath(__file__))[0], 'ps1grid.fits')
-rings = pyfits.open(gridfits)[1].data
+gridnames = ('zone', 'projcell', 'nband', 'dec', 'dec_min', 'dec_max', 'xcell', 'ycell', 'crpix1', 'crpix2')
+rings = None
+dec_min = None
+dec_max = None
+dec_centers = None
+dec_limit = None
+# the rings table as a dictionary of per-column arrays (native byte order), 
+# with cos/sin of the ring centers for findskycell_pixels
+ringcols = None
+
+def loadGrid(gridfile=gridfits):
+
+        """Load the tessellation rings table from gridfile
+
+        gridfile is either a FITS file with the table in its first extension (ps1grid.fits),
+        or a .npz file with one 'ring_<column>' array per column (as written by psCatalog.py),
+        which loads without importing astropy.
+        """
+
+        global rings, dec_min, dec_max, dec_centers, dec_limit, ringcols
+
+        if gridfile.endswith('.npz'):
+                with np.load(gridfile) as npz:
+                        rings = np.rec.fromarrays([npz['ring_'+name] for name in gridnames], names=gridnames)
+        else:
+                try:
+                        import astropy.io.fits as pyfits
+                except ImportError:
+                        import pyfits
+                rings = pyfits.open(gridfile)[1].data
+
+        # one contiguous native byte order array per column, so lookups are a single gather per column
+        ringcols = {name: np.ascontiguousarray(rings.field(name), dtype=rings.field(name).dtype.newbyteorder('='))
+                    for name in gridnames}
+
+        # Turning degrees into radians as needed
+        dec_min = np.deg2rad(ringcols['dec_min'])
+        dec_max = np.deg2rad(ringcols['dec_max'])
+        dec_centers = np.deg2rad(ringcols['dec'])
+        dec_limit = dec_min.min()
+
+        ringcols['cos_dec'] = ne.evaluate('cos(dec_centers)')
+        ringcols['sin_dec'] = ne.evaluate('sin(dec_centers)')
+
+
+def ringrow(i):
+
+        """Return ring i of the rings table as a dictionary of column values"""
+
+        return {name: ringcols[name][i] for name in gridnames}
+
+
+def getGrid():
+
+        """Return the rings table, loading ps1grid.fits if no table has been loaded yet"""
+
+        if rings is None:
+                loadGrid()
+        return rings
+
+
+def gridColumns():
+
+        """Return the rings table as a dictionary of native byte order arrays keyed by 'ring_<column>'"""
+
+        getGrid()
+        return {'ring_'+name: ringcols[name] for name in gridnames}
 
-# Turning degrees into radians as needed
-dec_min = np.deg2rad(rings.field('dec_min'))
-dec_max = np.deg2rad(rings.field('dec_max'))
-dec_centers = np.deg2rad(rings.field('dec'))
-dec_limit = dec_min.min()
 
 def findskycell(ra, dec):
 
@@ -47,6 +106,7 @@ def findskycell(ra, dec):
         y                       
         """
 
+        getGrid()
         if np.isscalar(ra) and np.isscalar(dec):
                 return _findskycell_array(np.array([ra]),np.array([dec]))
         if len(ra) == len(dec):
@@ -63,25 +123,23 @@ def _findskycell_array(ra, dec):
         idec = np.searchsorted(dec_max, dec)
 
         # special handling at pole where overlap is complicated
-	# do extra checks for top 2 rings
-	# always start with the ring just below the pole
-        nearpole = np.where(idec >= len(rings)-2)
-        idec[nearpole] = len(rings)-2
+        # do extra checks for top 2 rings
+        # always start with the ring just below the pole
+        nearpole = np.where(idec >= len(dec_max)-2)
+        idec[nearpole] = len(dec_max)-2
         
-        getfield = rings[idec].field
-        nband = getfield('nband')
+        nband = ringcols['nband'][idec]
 
         
         # get normalized RA in range 0..2pi
-        # NOTE: RA is normalized in place,
-        #       input RA angles are assumed to be in the range -2pi:4pi
-        nra = ra
-        nra[nra < 0] += 2*np.pi
-        nra[nra > 2*np.pi] -= 2*np.pi
+        # NOTE: input RA angles are assumed to be in the range -2pi:4pi
+        #       (the input array is not modified, the normalized RA is returned)
+        nra = np.where(ra < 0, ra + 2*np.pi, ra)
+        nra = np.where(nra > 2*np.pi, nra - 2*np.pi, nra)
         
         ira = (nra*nband/(2*np.pi) + 0.5).astype(int) % nband
 
-        projcell = getfield('projcell') + ira
+        projcell = ringcols['projcell'][idec] + ira
         dec_cen = dec_centers[idec] 
         ra_cen = ira*2*np.pi/nband      
 
@@ -95,20 +153,18 @@ def _findskycell_array(ra, dec):
         if len(nearpole[0]) > 0:
                 # handle the points near the pole (if any)
                 # we know that this "ring" has only a single field
-                getfield2 = rings[-1].field
-                projcell2 = getfield2('projcell')
-                dec_cen2 = np.deg2rad(getfield2('dec'))
+                projcell2 = ringcols['projcell'][-1:]
+                dec_cen2 = dec_centers[-1:]
                 ra_cen2 = 0.0
                 x2, y2 = sky2xy_tan(nra[nearpole], dec[nearpole], ra_cen2, dec_cen2)
                 # compare x,y and x2,y2 to image sizes to select best image
                 # returns a Boolean array with true for values where 2nd image is better
-                use2 = poleselect(x[nearpole], y[nearpole], x2, y2, rings[-2], rings[-1], pad)
+                use2 = poleselect(x[nearpole], y[nearpole], x2, y2, ringrow(-2), ringrow(-1), pad)
                 if use2.any():
                         # slightly obscure syntax here makes this work even if ra, dec are multi-dimensional
                         wuse2 = np.where(use2)[0]
-                        w2 = list(map(lambda x: x[wuse2], nearpole))
-                        idec[w2] = len(rings)-1
-                        getfield = rings[idec].field
+                        w2 = tuple(map(lambda x: x[wuse2], nearpole))
+                        idec[w2] = len(dec_max)-1
                         nband[w2] = 1
                         ira[w2] = 0
                         projcell[w2] = projcell2
@@ -118,15 +174,15 @@ def _findskycell_array(ra, dec):
                         y[w2] = y2[wuse2]
 
         # compute the subcell from the pixel location
-        px = getfield('xcell')-pad
-        py = getfield('ycell')-pad
+        px = ringcols['xcell'][idec]-pad
+        py = ringcols['ycell'][idec]-pad
         k = (4.5+x/px + 0.5).astype(int).clip(0,9)
         j = (4.5+y/py + 0.5).astype(int).clip(0,9)
         subcell = 10*j + k
 
         # get pixel coordinates within the skycell image
-        crpix1 = getfield('crpix1') + px*(5-k)
-        crpix2 = getfield('crpix2') + py*(5-j)
+        crpix1 = ringcols['crpix1'][idec] + px*(5-k)
+        crpix2 = ringcols['crpix2'][idec] + py*(5-j)
         ximage = (x + crpix1 + 0.5).astype(int)
         yimage = (y + crpix2 + 0.5).astype(int)
   
@@ -140,11 +196,275 @@ def _findskycell_array(ra, dec):
         yimage[w] = 0
 
         # return a dictionary
-        return {'ra': ra, 'dec': dec, 'projcell': projcell, 'subcell': subcell,
+        return {'ra': nra, 'dec': dec, 'projcell': projcell, 'subcell': subcell,
                 'crval1': ra_cen, 'crval2': dec_cen, 'crpix1': crpix1, 'crpix2': crpix2,
                 'x': ximage, 'y': yimage}
 
 
+def findskycell_pixels(ra, dec, dtype=np.float64, blocksize=16384):
+
+        """Given input arrays RA, DEC (radians), returns a dictionary with the skycell pixel for each position
+
+        This is the part of findskycell needed to sample the skycell images, evaluated blocksize positions
+        at a time (so the intermediate arrays stay in cache) with the trigonometry of the ring centers
+        taken from a table.
+        With dtype float64 the results are identical to findskycell's.
+        With dtype float32 the tangent projection is done in single precision, from the offsets to the
+        projection cell center, which is several times faster but can put positions within a small
+        fraction of a pixel of a pixel edge in the neighbouring pixel.
+        The input arrays are not modified, and can be any (matching) shape.
+        The return dictionary is indexed by column name, each column is an int32 array the shape of ra:
+        Column          Value
+        projcell        Projection cell (0 if outside coverage)
+        subcell         Subcell (0..99)
+        x                       Source pixel position in this skycell
+        y                       
+        """
+
+        getGrid()
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        if ra.shape != dec.shape:
+                raise ValueError("ra and dec must both be matching shape arrays")
+
+        result = {name: np.empty(ra.shape, dtype=np.int32) for name in ('projcell', 'subcell', 'x', 'y')}
+        _skycell_pixels_range(ra.reshape(-1), dec.reshape(-1), [result[name].reshape(-1) for name in ('projcell', 'subcell', 'x', 'y')],
+                              0, ra.size, dtype, blocksize)
+        return result
+
+
+def findskycell_batch(ra, dec, out=None, dtype=np.float64, chunksize=262144, blocksize=16384, threads=None):
+
+        """Given input arrays RA, DEC (radians) of any size, returns the dictionary of findskycell_pixels,
+        computed chunksize positions at a time on a pool of threads
+
+        Each chunk is evaluated blocksize positions at a time as in findskycell_pixels (so the results are
+        identical to it, and to findskycell's), and written straight into the output arrays, so the memory 
+        used besides the outputs is bounded by the number of threads and the block size.
+        out is an optional dictionary of preallocated C-contiguous integer arrays (projcell, subcell, x, y) 
+        the shape of ra, which are filled in place and returned.
+        threads is the number of threads (default the number of cpus).
+        """
+
+        getGrid()
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        if ra.shape != dec.shape:
+                raise ValueError("ra and dec must both be matching shape arrays")
+
+        names = ('projcell', 'subcell', 'x', 'y')
+        if out is None:
+                out = {name: np.empty(ra.shape, dtype=np.int32) for name in names}
+        for name in names:
+                if (out[name].shape != ra.shape) or (not out[name].flags.c_contiguous) or (out[name].dtype.kind not in 'iu'):
+                        raise ValueError("out must have C-contiguous integer arrays the shape of ra for " + ", ".join(names))
+
+        ra = np.ascontiguousarray(ra).reshape(-1)
+        dec = np.ascontiguousarray(dec).reshape(-1)
+        outs = [out[name].reshape(-1) for name in names]
+        starts = range(0, len(ra), chunksize)
+        if (threads == 1) or (len(starts) < 2):
+                _skycell_pixels_range(ra, dec, outs, 0, len(ra), dtype, blocksize)
+                return out
+
+        with ThreadPoolExecutor(threads or os.cpu_count()) as pool:
+                futures = [pool.submit(_skycell_pixels_range, ra, dec, outs, start, min(start+chunksize, len(ra)), dtype, blocksize)
+                           for start in starts]
+                for future in futures:
+                        future.result()
+        return out
+
+
+def _skycell_pixels_range(ra, dec, outs, start, stop, dtype=np.float64, blocksize=16384):
+
+        """Internal function: fills the (flat) output arrays outs (projcell, subcell, x, y) from start to stop,
+        blocksize positions at a time"""
+
+        for first in range(start, stop, blocksize):
+                block = slice(first, min(first+blocksize, stop))
+                _skycell_pixels_block(ra[block], dec[block], *[out[block] for out in outs], dtype=dtype)
+
+
+def _skycell_pixels_block(ra, dec, projcell, subcell, ximage, yimage, dtype=np.float64):
+
+        """Internal function: fills projcell, subcell, ximage, yimage for one block of positions
+
+        Follows _findskycell_array operation by operation, so the float64 results are identical.
+        """
+
+        pc, sc, xpos, ypos = _skycell_coords_block(ra, dec, dtype)
+        projcell[:] = pc
+        subcell[:] = sc
+        ximage[:] = (xpos + 0.5).astype(int)
+        yimage[:] = (ypos + 0.5).astype(int)
+
+        # insert zeros where we are below lowest dec_min
+        w = dec < dec_limit
+        projcell[w] = 0
+        subcell[w] = 0
+        ximage[w] = 0
+        yimage[w] = 0
+
+
+def _skycell_coords_block(ra, dec, dtype=np.float64):
+
+        """Internal function: returns projcell, subcell and the (unrounded) skycell pixel coordinates xpos, ypos
+        of a block of positions (positions below the lowest dec_min are not zeroed)
+        """
+
+        # find dec zone where rings.dec_min <= dec < rings.dec_max
+        # (positions in the top 2 rings start with the ring just below the pole)
+        below_pole = len(dec_max)-2
+        idec = np.searchsorted(dec_max, dec)
+        nearpole = np.nonzero(idec >= below_pole)[0]
+        idec[nearpole] = below_pole
+
+        # get normalized RA in range 0..2pi
+        nra = np.where(ra < 0, ra + 2*np.pi, ra)
+        nra = np.where(nra > 2*np.pi, nra - 2*np.pi, nra)
+
+        nband = ringcols['nband'][idec]
+        ira = (nra*nband/(2*np.pi) + 0.5).astype(int) % nband
+        ra_cen = ira*2*np.pi/nband
+
+        # use tangent project to get pixel offsets
+        x, y = _tan_project(nra, dec, ra_cen, idec, dtype)
+
+        pad = 480
+
+        if len(nearpole) > 0:
+                # handle the points near the pole (if any), the pole "ring" has only a single field
+                x2, y2 = _tan_project(nra[nearpole], dec[nearpole], 0.0, np.full(len(nearpole), below_pole+1), dtype)
+                use2 = poleselect(x[nearpole], y[nearpole], x2, y2, ringrow(-2), ringrow(-1), pad)
+                w2 = nearpole[use2]
+                idec[w2] = below_pole+1
+                ira[w2] = 0
+                x[w2] = x2[use2]
+                y[w2] = y2[use2]
+
+        # compute the subcell from the pixel location
+        px = ringcols['xcell'][idec]-pad
+        py = ringcols['ycell'][idec]-pad
+        k = (4.5+x/px + 0.5).astype(int).clip(0,9)
+        j = (4.5+y/py + 0.5).astype(int).clip(0,9)
+
+        # pixel coordinates within the skycell image (before rounding)
+        xpos = x + (ringcols['crpix1'][idec] + px*(5-k))
+        ypos = y + (ringcols['crpix2'][idec] + py*(5-j))
+        return ringcols['projcell'][idec] + ira, 10*j + k, xpos, ypos
+
+
+def findskycell_interp(ra, dec, tolerance=0.1, dtype=np.float64, step=32):
+
+        """Given 2-d grids RA, DEC (radians), such as a tile's pixel centers, returns the same dictionary as
+        findskycell_pixels, interpolating the skycell pixel positions where the grid lies in a single skycell
+
+        The exact positions are computed on a control grid (every step-th row and column, plus the last),
+        and if all the control points are in one skycell the positions of the other points are interpolated
+        bilinearly between them. The interpolation is checked against the exact positions at the center
+        of every control cell, and if it is off by more than tolerance pixels there (or the grid is
+        not in a single skycell) the exact positions of every point are computed with findskycell_pixels.
+        Elsewhere the error is not checked, so tolerance is a bound on the checked points only (the error
+        of a smooth tile is largest near the cell centers; test_ps1skycell_toast.py checks every pixel of some tiles).
+        Interpolated points within tolerance of a pixel edge may be put in the neighbouring pixel.
+        The return dictionary also has a boolean 'interpolated' entry.
+        """
+
+        getGrid()
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        if ra.shape != dec.shape:
+                raise ValueError("ra and dec must both be matching shape arrays")
+
+        if (ra.ndim == 2) and (min(ra.shape) > 2*step):
+                # control rows/columns, and the rows/columns halfway between them
+                rows = np.unique(np.append(np.arange(0, ra.shape[0], step), ra.shape[0]-1))
+                cols = np.unique(np.append(np.arange(0, ra.shape[1], step), ra.shape[1]-1))
+                midrows = (rows[:-1] + rows[1:])//2
+                midcols = (cols[:-1] + cols[1:])//2
+                ctrl = np.ix_(rows, cols)
+                check = np.ix_(midrows, midcols)
+                cra = np.concatenate([ra[ctrl].reshape(-1), ra[check].reshape(-1)])
+                cdec = np.concatenate([dec[ctrl].reshape(-1), dec[check].reshape(-1)])
+                projcell, subcell, xpos, ypos = _skycell_coords_block(cra, cdec, dtype)
+
+                if ((projcell == projcell[0]).all() and (subcell == subcell[0]).all() 
+                    and (cdec >= dec_limit).all()):
+                        nctrl = len(rows)*len(cols)
+                        xgrid = xpos[:nctrl].reshape(len(rows), len(cols))
+                        ygrid = ypos[:nctrl].reshape(len(rows), len(cols))
+                        error = max(np.abs(_bilinear(xgrid, rows, cols, midrows, midcols) - xpos[nctrl:].reshape(len(midrows), -1)).max(),
+                                    np.abs(_bilinear(ygrid, rows, cols, midrows, midcols) - ypos[nctrl:].reshape(len(midrows), -1)).max())
+                        if error <= tolerance:
+                                allrows = np.arange(ra.shape[0])
+                                allcols = np.arange(ra.shape[1])
+                                return {'projcell': np.full(ra.shape, projcell[0], dtype=np.int32),
+                                        'subcell': np.full(ra.shape, subcell[0], dtype=np.int32),
+                                        'x': (_bilinear(xgrid, rows, cols, allrows, allcols) + 0.5).astype(np.int32),
+                                        'y': (_bilinear(ygrid, rows, cols, allrows, allcols) + 0.5).astype(np.int32),
+                                        'interpolated': True}
+
+        result = findskycell_pixels(ra, dec, dtype)
+        result['interpolated'] = False
+        return result
+
+
+def _bilinear(grid, rows, cols, outrows, outcols):
+
+        """Internal function: bilinear interpolation of grid (values at rows x cols) at outrows x outcols"""
+
+        def weights(knots, points):
+                seg = (np.searchsorted(knots, points, side='right') - 1).clip(0, len(knots)-2)
+                return seg, (points - knots[seg])/(knots[seg+1] - knots[seg])
+
+        r, tr = weights(rows, outrows)
+        c, tc = weights(cols, outcols)
+        # interpolating along the rows, then the columns
+        top = grid[r] + (grid[r+1] - grid[r])*tr[:, None]
+        return top[:, c] + (top[:, c+1] - top[:, c])*tc
+
+
+def _tan_project(ra, dec, ra_cen, idec, dtype=np.float64):
+
+        """Internal function: tangent projection (as sky2xy_tan) onto the centers of rings idec at ra_cen
+
+        With dtype float32 the projection is computed in single precision from the offsets to the center.
+        """
+
+        # as in sky2xy_tan (the off-diagonal terms are zero)
+        cd00 = -pixscale*np.pi/(180*3600)
+        cd11 = -cd00
+        determ = cd00*cd11
+        cdinv00 = cd11/determ
+        cdinv11 = cd00/determ
+
+        radif = ra - ra_cen
+        radif[radif > np.pi] -= 2*np.pi
+        radif[radif < -np.pi] += 2*np.pi
+
+        if np.dtype(dtype) == np.float64:
+                cos_crval1 = ringcols['cos_dec'][idec]
+                sin_crval1 = ringcols['sin_dec'][idec]
+                cos_dec = ne.evaluate('cos(dec)')
+                sin_dec = ne.evaluate('sin(dec)')
+                cos_radif = ne.evaluate('cos(radif)')
+                h = ne.evaluate('sin_dec*sin_crval1 + cos_dec*cos_crval1*cos_radif')
+                x = ne.evaluate('cdinv00*(cos_dec*sin(radif)/h)')
+                y = ne.evaluate('cdinv11*((sin_dec*cos_crval1 - cos_dec*sin_crval1*cos_radif)/h)')
+                return x, y
+
+        # single precision, with the differences taken in double precision first
+        cos_crval1 = ringcols['cos_dec'][idec].astype(dtype)
+        sin_crval1 = ringcols['sin_dec'][idec].astype(dtype)
+        ddec = (dec - dec_centers[idec]).astype(dtype)
+        radif = radif.astype(dtype)
+        cos_dec = np.cos(dec.astype(dtype))
+        hav = 2*np.sin(radif/2)**2  # 1 - cos(radif)
+        h = np.cos(ddec) - cos_dec*cos_crval1*hav
+        x = (cdinv00*cos_dec)*np.sin(radif)/h
+        y = cdinv11*(np.sin(ddec) + cos_dec*sin_crval1*hav)/h
+        return x, y
+
 
 def poleselect(x1, y1, x2, y2, rings1, rings2, pad):
 
@@ -186,6 +506,7 @@ def getskycell_center(projcell, subcell):
         y                       
         """
 
+        getGrid()
         if np.isscalar(projcell) and np.isscalar(subcell):
                 return _getskycell_center_array(np.array([projcell]),np.array([subcell]))
         if len(projcell) == len(subcell):
@@ -202,11 +523,10 @@ def _getskycell_center_array(projcell, subcell):
         """
 
         # find dec zone where rings.projcell <= projcell
-        idec = (np.searchsorted(rings.field('projcell'), projcell+1)-1).clip(0)
-        getfield = rings[idec].field
-        nband = getfield('nband')
-        ira = (projcell - getfield('projcell')).clip(0,nband)
-        dec_cen = getfield('dec')
+        idec = (np.searchsorted(ringcols['projcell'], projcell+1)-1).clip(0)
+        nband = ringcols['nband'][idec]
+        ira = (projcell - ringcols['projcell'][idec]).clip(0,nband)
+        dec_cen = ringcols['dec'][idec]
         ra_cen = ira*360.0/nband
 
         # locate subcell within the projection cell
@@ -214,14 +534,14 @@ def _getskycell_center_array(projcell, subcell):
         j = (subcell//10) % 10
 
         pad = 480
-        px = getfield('xcell')-pad
-        py = getfield('ycell')-pad
+        px = ringcols['xcell'][idec]-pad
+        py = ringcols['ycell'][idec]-pad
         ximage = 0.5*(px+pad-1)
         yimage = 0.5*(py+pad-1)
 
         # get pixel coordinates within the skycell image
-        crpix1 = getfield('crpix1') + px*(5-k)
-        crpix2 = getfield('crpix2') + py*(5-j)
+        crpix1 = ringcols['crpix1'][idec] + px*(5-k)
+        crpix2 = ringcols['crpix2'][idec] + py*(5-j)
         # position in projection cell
         x = ximage - crpix1
         y = yimage - crpix2
@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+
+"""Offline benchmarks for the panstarrs toasting pipeline.
+
+Each benchmark returns a dictionary of timings and accuracy measures,
+the command line prints them (and optionally writes them) as JSON.
+"""
+
+import sys, getopt, os
+
+import numpy as np
+
+import json
+import time
+import tempfile
+
+import ps1skycell_toast as pssc
+import psTiles
+
+
+def syntheticSkycell(shape=(6250,6250), seed=0):
+    """Returns a PS1-like float32 skycell image: heavy tailed sky noise, some stars, and a nan border."""
+    rng = np.random.default_rng(seed)
+    imgData = (rng.standard_t(3,size=shape)*5).astype(np.float32)
+    ys = rng.integers(0,shape[0],200)
+    xs = rng.integers(0,shape[1],200)
+    imgData[ys,xs] = rng.uniform(1e3,1e5,200)
+    imgData[:shape[0]//20,:] = np.nan
+    imgData[:,:shape[1]//30] = np.nan
+    return imgData
+
+
+def writeSkycell(filename, shape=(6250,6250), seed=0, compressed=True):
+    """Writes a synthetic skycell (see syntheticSkycell) as a FITS file with the image in the first extension,
+    RICE compressed as the PS1 stacks are (unless compressed is False)."""
+    from astropy.io import fits
+
+    imgData = syntheticSkycell(shape, seed)
+    hdu = fits.CompImageHDU(imgData) if compressed else fits.ImageHDU(imgData)
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(filename, overwrite=True)
+
+
+def syntheticCatalog(directory, cells, shape=(6250,6250), compressed=True):
+    """
+    Writes synthetic skycell FITS files and a file location catalog (as the filter_*_rings.rpt files) for them.
+
+    Parameters
+    ----------
+    directory: string
+      Directory the files and the catalog (rings.rpt) are written to.
+    cells: list
+      The (projcell, subcell) skycells to write files for.
+    shape, compressed:
+      As for writeSkycell.
+
+    Returns
+    -------
+    The catalog file path.
+    """
+
+    catalogFile = os.path.join(directory, 'rings.rpt')
+    with open(catalogFile, 'w') as fle:
+        fle.write("SCn SCm fileNPath\n")
+        for seed, (projcell, subcell) in enumerate(cells):
+            filename = os.path.join(directory, 'skycell.%04d.%03d.fits' % (projcell, subcell))
+            writeSkycell(filename, shape, seed, compressed)
+            fle.write("%d %d %s\n" % (projcell, subcell, filename))
+    return catalogFile
+
+
+def originalNormalize(imgData):
+    """The skycell normalization as originally done in psTOAST.fitsCache.add."""
+    from toasty.norm import normalize
+
+    imean = np.nanmean(imgData)
+    vmax = (np.percentile(imgData[imgData >= imean],99.5) + 4.3) / 2
+    vmin = (np.percentile(imgData[imgData <= imean],0.5) - 1.3) / 2
+    imgData[np.isnan(imgData)] = vmax
+    return normalize(imgData,vmin,vmax,stretch='sinh'), (vmin, vmax)
+
+
+def originalColorize(g, r, i, z):
+    """The band colorizing as originally done in psColorize.colorize."""
+    G = g.astype(np.float64)
+    R = r.astype(np.float64)
+    I = i.astype(np.float64)
+    Z = z.astype(np.float64)
+    g, r, i, z = g.copy(), r.copy(), i.copy(), z.copy()
+
+    maxDif = 175
+    PM = np.median(np.array([G,R,I,Z]), axis=0)
+    g[((G - PM) > maxDif) & (g == 255)] = 0
+    r[((R - PM) > maxDif) & (r == 255)] = 0
+    i[((I - PM) > maxDif) & (i == 255)] = 0
+    z[((Z - PM) > maxDif) & (z == 255)] = 0
+
+    return np.dstack((np.mean(np.array([i,z]),axis=0).astype(np.uint8),
+                      np.mean(np.array([r,r,i]),axis=0).astype(np.uint8),
+                      np.mean(np.array([g,g,r]),axis=0).astype(np.uint8)))
+
+
+def timed(func, *args, **kwargs):
+    """Returns (result, seconds) of calling func."""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+
+def benchNormalize(shape=(6250,6250), repeats=3, subsample=16):
+    """
+    Benchmark skycell normalization against the original code.
+
+    Times the original limits+stretch, psNormalize.skycellLimits (exact, and subsampled), and both
+    normalizeSkycell engines, and reports the difference in limits and in the uint8 tile values.
+    """
+    import psNormalize
+
+    imgData = syntheticSkycell(shape)
+    results = {'shape': list(shape), 'repeats': repeats}
+
+    times = []
+    for _ in range(repeats):
+        (refImg, refLimits), sec = timed(originalNormalize, imgData.copy())
+        times.append(sec)
+    results['original_sec'] = min(times)
+    refTile = refImg.astype(np.uint8)
+
+    for name, sub in (('limits', 1), ('limits_subsampled', subsample)):
+        times = []
+        for _ in range(repeats):
+            limits, sec = timed(psNormalize.skycellLimits, imgData.copy(), sub)
+            times.append(sec)
+        results[name + '_sec'] = min(times)
+        results[name + '_error'] = float(max(abs(limits[0] - refLimits[0]), abs(limits[1] - refLimits[1])))
+
+    for engine in psNormalize.engines:
+        times = []
+        for _ in range(repeats):
+            normImg, sec = timed(psNormalize.normalizeSkycell, imgData.copy(), engine)
+            times.append(sec)
+        results[engine + '_sec'] = min(times)
+        results[engine + '_max_abs_diff'] = float(np.abs(normImg - refImg).max())
+        results[engine + '_tile_pixels_differing'] = int(np.count_nonzero(normImg.astype(np.uint8) != refTile))
+
+    return results
+
+
+def validationPositions(n=1000000, seed=0):
+    """Returns (ra, dec) arrays (radians) of n positions uniform on the sphere, plus n/4 each 
+    near the north pole, around the southern coverage limit, and at ra 0/2pi."""
+    rng = np.random.default_rng(seed)
+    m = n//4
+    ra = np.concatenate([rng.uniform(0,2*np.pi,n), rng.uniform(0,2*np.pi,m), rng.uniform(0,2*np.pi,m),
+                         rng.choice([0, 1e-12, 2*np.pi - 1e-12, np.pi],m)])
+    dec = np.concatenate([np.arcsin(rng.uniform(-1,1,n)), np.radians(rng.uniform(86,90,m)), 
+                          np.radians(rng.uniform(-31,-29,m)), rng.uniform(-0.6,1.5,m)])
+    return ra, dec
+
+
+def benchFindskycell(n=1000000, repeats=3):
+    """
+    Benchmark ps1skycell_toast.findskycell_pixels against findskycell.
+
+    Times both on a validation set (see validationPositions) and reports the number of
+    positions whose (projcell, subcell, x, y) differ, for each findskycell_pixels precision,
+    and for findskycell_batch (float64, on all the cpus).
+    """
+
+    ra, dec = validationPositions(n)
+    results = {'positions': len(ra), 'repeats': repeats}
+
+    times = []
+    for _ in range(repeats):
+        ref, sec = timed(pssc.findskycell, ra.copy(), dec.copy())
+        times.append(sec)
+    results['findskycell_sec'] = min(times)
+
+    for dtype in ('float64', 'float32'):
+        times = []
+        for _ in range(repeats):
+            pix, sec = timed(pssc.findskycell_pixels, ra, dec, dtype)
+            times.append(sec)
+        results[dtype + '_sec'] = min(times)
+        results[dtype + '_positions_differing'] = int(np.count_nonzero(
+            np.any([pix[col] != ref[col] for col in ('projcell','subcell','x','y')], axis=0)))
+        results[dtype + '_skycells_differing'] = int(np.count_nonzero(
+            (pix['projcell'] != ref['projcell']) | (pix['subcell'] != ref['subcell'])))
+
+    # the threaded batch version, into preallocated outputs
+    out = {col: np.empty(ra.shape, dtype=np.int32) for col in ('projcell','subcell','x','y')}
+    times = []
+    for _ in range(repeats):
+        pix, sec = timed(pssc.findskycell_batch, ra, dec, out)
+        times.append(sec)
+    results['batch_sec'] = min(times)
+    results['batch_threads'] = os.cpu_count()
+    results['batch_positions_differing'] = int(np.count_nonzero(
+        np.any([pix[col] != ref[col] for col in ('projcell','subcell','x','y')], axis=0)))
+
+    return results
+
+
+def benchInterp(nTiles=200, depth=12, tolerance=0.1, seed=0):
+    """
+    Benchmark ps1skycell_toast.findskycell_interp against findskycell_pixels on random TOAST tiles.
+
+    Reports the fraction of tiles interpolated, the time per tile of both on those tiles, and the
+    largest difference between the interpolated and exact (unrounded) skycell pixel positions over
+    all their pixels, which should be within the tolerance, and the number of pixels sampled one over.
+    """
+
+    rng = np.random.default_rng(seed)
+    results = {'tiles': nTiles, 'depth': depth, 'tolerance': tolerance}
+    exactSec, interpSec, maxError, nInterp, differing = 0, 0, 0, 0, 0
+
+    for tx, ty in rng.integers(0, 2**depth, (nTiles, 2)):
+        ra, dec = psTiles.tileLonLat(psTiles.getTile(depth, int(tx), int(ty)))
+        interp, sec = timed(pssc.findskycell_interp, ra, dec, tolerance)
+        if not interp['interpolated']:
+            continue
+        nInterp += 1
+        interpSec += sec
+        exact, sec = timed(pssc.findskycell_pixels, ra, dec)
+        exactSec += sec
+        differing += int(np.count_nonzero((interp['x'] != exact['x']) | (interp['y'] != exact['y'])))
+
+        # the interpolation of the unrounded positions, as done by findskycell_interp
+        _, _, xpos, ypos = pssc._skycell_coords_block(ra.reshape(-1), dec.reshape(-1))
+        rows = np.unique(np.append(np.arange(0, ra.shape[0], 32), ra.shape[0] - 1))
+        cols = np.unique(np.append(np.arange(0, ra.shape[1], 32), ra.shape[1] - 1))
+        allRows, allCols = np.arange(ra.shape[0]), np.arange(ra.shape[1])
+        for pos in (xpos.reshape(ra.shape), ypos.reshape(ra.shape)):
+            approx = pssc._bilinear(pos[np.ix_(rows, cols)], rows, cols, allRows, allCols)
+            maxError = max(maxError, float(np.abs(approx - pos).max()))
+
+    results['tiles_interpolated'] = nInterp
+    results['exact_sec_per_tile'] = exactSec / max(nInterp, 1)
+    results['interp_sec_per_tile'] = interpSec / max(nInterp, 1)
+    results['max_error_pixels'] = maxError
+    results['within_tolerance'] = maxError <= tolerance
+    results['pixels_differing'] = differing
+    return results
+
+
+def decBands():
+    """Returns the declination bands (name, decMin, decMax in degrees) findskycell is timed in: 30 degree bands
+    from the coverage limit, then the rest of the sky below the two polar rings, the ring below the pole, and 
+    the pole ring (positions in the top two rings go through poleselect)."""
+    pssc.getGrid()
+    decLimit, belowPole, pole = np.degrees([pssc.dec_limit, pssc.dec_min[-2], pssc.dec_min[-1]])
+    bands = [('dec_%d_%d' % (low, high), low, high) for low, high in 
+             zip([decLimit, -15, 15, 45], [-15, 15, 45, 75])]
+    return bands + [('dec_75_below_pole_ring', 75, belowPole), ('ring_below_pole', belowPole, pole), 
+                    ('pole_ring', pole, 90)]
+
+
+def benchDecBands(n=200000, repeats=3, seed=0):
+    """
+    Benchmark findskycell and findskycell_pixels in declination bands (see decBands), 
+    reporting positions per second for each, with positions uniform on the sky in each band.
+    """
+
+    rng = np.random.default_rng(seed)
+    results = {'positions': n, 'repeats': repeats}
+    for name, low, high in decBands():
+        ra = rng.uniform(0, 2*np.pi, n)
+        dec = np.arcsin(rng.uniform(np.sin(np.radians(low)), np.sin(np.radians(high)), n))
+        for func in (pssc.findskycell, pssc.findskycell_pixels):
+            times = []
+            for _ in range(repeats):
+                _, sec = timed(func, ra.copy(), dec.copy())
+                times.append(sec)
+            results[name + '_' + func.__name__ + '_per_sec'] = n / min(times)
+    return results
+
+
+def findTiles(depth=12, seed=0, maxTries=10000):
+    """Returns a dictionary of depth depth tiles by kind: 'interior' (in one skycell), 'boundary' (in two), 
+    and 'multi' (in three or more), found among random tiles in the survey coverage."""
+    import psTiles
+
+    rng = np.random.default_rng(seed)
+    tiles = {}
+    for _ in range(maxTries):
+        tile = psTiles.getTile(depth, *[int(v) for v in rng.integers(0, 2**depth, 2)])
+        info = pssc.findskycell_pixels(*psTiles.tileLonLat(tile, 16))
+        if (info['projcell'] == 0).any():
+            continue
+        nCells = len(np.unique(info['projcell'].astype(np.int64)*100 + info['subcell']))
+        kind = 'interior' if nCells == 1 else ('boundary' if nCells == 2 else 'multi')
+        tiles.setdefault(kind, tile)
+        if len(tiles) == 3:
+            break
+    return tiles
+
+
+def benchSampler(depth=12, repeats=5, shape=(6250,6250)):
+    """
+    Benchmark psTOAST's sampler (vec2Pix) on interior, boundary, and multi skycell tiles (see findTiles), 
+    and fitsCache image loading, with synthetic skycell files written to a temporary directory.
+
+    Reports tiles per second with the images cached (and the time of the first call, which loads them),
+    and the time to load (read, and compute the limits and normalize) an image with each normalization engine.
+    """
+    import psTiles
+    import psTOAST
+    import psNormalize
+
+    tiles = findTiles(depth)
+    lonLats = {kind: psTiles.tileLonLat(tile) for kind, tile in tiles.items()}
+    cells = set()
+    for raArr, decArr in lonLats.values():
+        info = pssc.findskycell_pixels(raArr, decArr)
+        cells |= set(zip(info['projcell'].reshape(-1).tolist(), info['subcell'].reshape(-1).tolist()))
+
+    results = {'depth': depth, 'repeats': repeats, 'skycells': len(cells)}
+    with tempfile.TemporaryDirectory(prefix='psBenchmark') as directory:
+        catalogFile = syntheticCatalog(directory, sorted(cells), shape)
+        sampler = psTOAST.panstarrsSampler(catalogFile)
+        maxBytes = psTOAST.psCache.maxBytes
+        psTOAST.psCache.setMaxBytes(2*len(cells)*np.prod(shape)*8)
+        for kind, (raArr, decArr) in lonLats.items():
+            results[kind + '_tile'] = list(tiles[kind].pos)
+            _, results[kind + '_first_sec'] = timed(sampler, raArr, decArr)
+            times = []
+            for _ in range(repeats):
+                _, sec = timed(sampler, raArr, decArr)
+                times.append(sec)
+            results[kind + '_tiles_per_sec'] = 1 / min(times)
+
+        filename = os.path.join(directory, 'skycell.%04d.%03d.fits' % min(cells))
+        for engine in psNormalize.engines:
+            cache = psTOAST.fitsCache(2**31, normEngine=engine)
+            times = []
+            for _ in range(repeats):
+                _, sec = timed(cache.load, filename)
+                times.append(sec)
+            results['fitscache_load_' + engine + '_sec'] = min(times)
+        psTOAST.psCache.clear()
+        psTOAST.psCache.setMaxBytes(maxBytes)
+    return results
+
+
+def syntheticMosaics(n=16, size=512, channels=3, seed=0):
+    """Returns n uint8 size x size mosaics (with channels colour channels, greyscale if 0) looking like the 
+    toasted tiles: noisy sky with some saturated stars, and an empty (black) corner."""
+    rng = np.random.default_rng(seed)
+    shape = (n, size, size) + ((channels,) if channels else ())
+    mosaics = np.clip(rng.normal(40, 15, shape), 0, 255)
+    for img in mosaics:
+        ys, xs = rng.integers(2, size - 2, (2, 50))
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                img[ys + dy, xs + dx] = 255
+        img[:size//4, :size//3] = 0
+    return mosaics.astype(np.uint8)
+
+
+def benchMerge(n=16, repeats=3):
+    """
+    Benchmark psMerge's merge engines (see psMerge.mergeEngines) on synthetic greyscale and colour mosaics
+    (see syntheticMosaics).
+
+    Reports tiles per second of each engine's bicubic, nearest neighbor (PIL's default resize), and true nearest 
+    neighbor merges, one mosaic at a time and (for the array engines) for the whole batch at once, and their 
+    difference from the PIL merges.
+    """
+    import psMerge
+
+    results = {'mosaics': n, 'repeats': repeats}
+    for mode, channels in (('grey', 0), ('rgb', 3)):
+        mosaics = syntheticMosaics(n, channels=channels)
+        for engine, funcs in psMerge.mergeEngines.items():
+            for kind, func, pilFunc in zip(('bicubic', 'nearest', 'truenearest'), funcs + (psMerge.nearestMerges[engine],),
+                                           psMerge.mergeEngines['pil'] + (psMerge.mergeNearest,)):
+                name = '_'.join((mode, engine, kind))
+                times = []
+                for _ in range(repeats):
+                    merged, sec = timed(lambda: [func(mosaic) for mosaic in mosaics])
+                    times.append(sec)
+                results[name + '_tiles_per_sec'] = n / min(times)
+                if engine != 'pil':
+                    times = []
+                    for _ in range(repeats):
+                        _, sec = timed(func, mosaics)
+                        times.append(sec)
+                    results[name + '_batch_tiles_per_sec'] = n / min(times)
+                    diff = np.abs(np.array(merged, dtype=int) - [pilFunc(mosaic) for mosaic in mosaics])
+                    results[name + '_max_abs_diff'] = int(diff.max())
+                    results[name + '_mean_abs_diff'] = float(diff.mean())
+    return results
+
+
+def benchDespeckle(n=16, repeats=3):
+    """
+    Benchmark psSmoothing's de-speckling, despeckleArray against despeckleImage (PIL and cv2), on synthetic 
+    greyscale and colour tiles (see syntheticMosaics), with all the steps (smooth, enhance, threshold) and 
+    with only the enhance and threshold steps.
+
+    Reports tiles per second of each, and the number of pixels that differ and their largest difference.
+    """
+    from PIL import Image
+    import psSmoothing
+
+    results = {'tiles': n, 'repeats': repeats}
+    for mode, channels in (('grey', 0), ('rgb', 3)):
+        tiles = syntheticMosaics(n, 256, channels)
+        for steps, smooth in (('all', True), ('no_smooth', False)):
+            name = mode + '_' + steps
+            for engine, func in (('pil', lambda tile: np.asarray(psSmoothing.despeckleImage(Image.fromarray(tile), 
+                                                                                             True, smooth, True))),
+                                 ('numpy', lambda tile: psSmoothing.despeckleArray(tile, True, smooth, True))):
+                times = []
+                for _ in range(repeats):
+                    cleaned, sec = timed(lambda: np.array([func(tile) for tile in tiles], dtype=int))
+                    times.append(sec)
+                results[name + '_' + engine + '_tiles_per_sec'] = n / min(times)
+                if engine == 'pil':
+                    reference = cleaned
+            results[name + '_pixels_differing'] = int(np.count_nonzero(cleaned != reference))
+            results[name + '_max_abs_diff'] = int(np.abs(cleaned - reference).max())
+    return results
+
+
+def benchColorize(n=16, repeats=3, seed=0):
+    """
+    Benchmark psColorize.colorizeBands against the original colorizing, on synthetic band tiles (see 
+    syntheticMosaics) with saturated pixels added to single bands (which are masked) and to all bands.
+
+    Reports tiles per second of each and the number of pixels that differ.
+    """
+    import psColorize
+
+    rng = np.random.default_rng(seed)
+    bands = syntheticMosaics(4*n, 256, 0, seed).reshape(n, 4, 256, 256)
+    for tile in bands:
+        ys, xs = rng.integers(0, 256, (2, 500))
+        tile[rng.integers(0, 4, 500), ys, xs] = 255
+        tile[:, ys[:100], xs[:100]] = 255
+
+    results = {'tiles': n, 'repeats': repeats}
+    for name, func in (('original', originalColorize), ('integer', psColorize.colorizeBands)):
+        times = []
+        for _ in range(repeats):
+            rgbs, sec = timed(lambda: [func(*tile) for tile in bands])
+            times.append(sec)
+        results[name + '_tiles_per_sec'] = n / min(times)
+        if name == 'original':
+            reference = rgbs
+    results['pixels_differing'] = int(sum(np.count_nonzero(rgb != ref) for rgb, ref in zip(rgbs, reference)))
+    results['dtype_shape_match'] = all((rgb.dtype == ref.dtype) and (rgb.shape == ref.shape) 
+                                       for rgb, ref in zip(rgbs, reference))
+    return results
+
+
+benchmarks = {'normalize': benchNormalize, 'findskycell': benchFindskycell, 'interp': benchInterp, 
+              'decbands': benchDecBands, 'sampler': benchSampler, 'merge': benchMerge,
+              'despeckle': benchDespeckle, 'colorize': benchColorize}
+
+
+def usage():
+    print("psBenchmark.py [-b <benchmark,...>] [-o <outputfile>]")
+    print("""
+    Run offline benchmarks of the toasting pipeline, printing the results as JSON.
+
+    Parameters
+    ----------
+    benchmarks (-b): string (optional)
+      Comma separated list of benchmarks to run (default all): """ + ", ".join(benchmarks) + """
+    outputFile (-o): string (optional)
+      File the JSON results are also written to.
+    """)
+
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:],"hb:o:",["help","benchmarks=","outputfile="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    toRun = list(benchmarks)
+    outputFile = ''
+
+    for opt, arg in opts:
+        if opt in ('-h','--help'):
+            usage()
+            sys.exit()
+        if opt in ('-b','--benchmarks'):
+            toRun = arg.split(',')
+            if not set(toRun) <= set(benchmarks):
+                print("Benchmarks must be from: " + ", ".join(benchmarks))
+                sys.exit(2)
+        if opt in ('-o','--outputfile'):
+            outputFile = arg
+
+    results = {}
+    for name in toRun:
+        results[name] = benchmarks[name]()
+
+    print(json.dumps(results, indent=2))
+    if outputFile:
+        with open(outputFile,'w') as fle:
+            json.dump(results, fle, indent=2)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import sys, getopt
+
+import numpy as np
+
+import time
+
+import ps1skycell_toast as pssc
+
+
+def readCatalog(filelocFile):
+    """
+    Read the panstarrs skycell file location catalog.
+
+    Parameters
+    ----------
+    filelocFile: string
+      File that contains the panstarrs images file locations organized by skycell.
+      Either a fixed-width table with columns 'SCn,' 'SCm,' and 'fileNPath' (one of the filter_*_rings.rpt files),
+      or a catalog compiled from one by compileCatalog (.npz).
+      The tessellation rings table in a compiled catalog is also loaded into ps1skycell_toast.
+
+    Returns
+    -------
+    (fileIds, filePths) where fileIds is an int32 array indexed by (projcell, subcell) giving the index of
+    the skycell's file in the filePths list, or -1 where there is no file.
+    """
+
+    if filelocFile.endswith('.npz'):
+        with np.load(filelocFile) as npz:
+            fileIds = npz['fileIds']
+            filePths = [x.decode() for x in npz['filePths']]
+            if 'ring_projcell' in npz:
+                pssc.loadGrid(filelocFile)
+        return fileIds, filePths
+
+    from astropy.io import ascii
+
+    psCells = ascii.read(filelocFile)
+    filePths = [str(x) for x in psCells['fileNPath']]
+    # the table covers every skycell of the tessellation, so any findskycell result can index it
+    grid = pssc.getGrid()
+    nProjcell = int(grid.field('projcell')[-1] + grid.field('nband')[-1])
+    fileIds = np.full((max(nProjcell,max(psCells['SCn']) + 1),max(100,max(psCells['SCm']) + 1)),-1,dtype=np.int32)
+    fileIds[psCells['SCn'],psCells['SCm']] = np.arange(len(filePths),dtype=np.int32)
+    return fileIds, filePths
+
+
+def compileCatalog(filelocFile, outFile):
+    """
+    Compile the panstarrs skycell file location catalog into a binary (.npz) file that loads in milliseconds.
+
+    Parameters
+    ----------
+    filelocFile: string
+      File that contains the panstarrs images file locations organized by skycell.
+      File format is fixed-width table with columns 'SCn,' 'SCm,' and 'fileNPath.'
+    outFile: string
+      The compiled catalog file (should end in .npz). It holds the (projcell, subcell) file index table,
+      the file paths, and the tessellation rings table from ps1grid.fits.
+    """
+
+    fileIds, filePths = readCatalog(filelocFile)
+    np.savez(outFile, fileIds=fileIds, filePths=np.array([x.encode() for x in filePths]), **pssc.gridColumns())
+
+
+def usage():
+    print("psCatalog.py -i <inputfile> -o <outputfile>")
+    print("""
+    Compile a panstarrs skycell file location catalog into a binary (.npz) file,
+    which can be given to psTOAST.py in place of the original catalog for fast startup.
+
+    Parameters
+    ----------
+    inputFile: string
+      File that contains the panstarrs images file locations organized by skycell.
+      File format is fixed-width table with columns 'SCn,' 'SCm,' and 'fileNPath.'
+    outputFile: string
+      The compiled catalog file (should end in .npz).
+    """)
+
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:],"hi:o:",["help","inputfile=","outputfile="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    inputFile = ''
+    outputFile = ''
+
+    for opt, arg in opts:
+        if opt in ('-h','--help'):
+            usage()
+            sys.exit()
+        if opt in ('-i','--inputfile'):
+            inputFile = arg
+        if opt in ('-o','--outputfile'):
+            outputFile = arg
+
+    if not (inputFile and outputFile):
+        print("Inputfile and outputfile are required arguments.")
+        usage()
+        sys.exit(2)
+
+    if not outputFile.endswith('.npz'):
+        print("Outputfile must end in .npz")
+        sys.exit(2)
+
+    start = time.time()
+    compileCatalog(inputFile, outputFile)
+    end = time.time()
+    print(end - start)
@@ -13,15 +13,46 @@ import sys, getopt,os
 
 import numpy as np
 
-from itertools import product
 from subprocess import run
 from skimage.io import imread,imsave
 
+import psTiles
+
 import time
 
 import warnings
 warnings.filterwarnings("ignore", ".* is a low contrast image")
 
+# bad pixels will be sturated in only one band (hopefully), 
+# and are masked if they are more than maxDif above the median of the 4 bands
+maxDif = 175
+
+
+def colorizeBands(g,r,i,z):
+    """
+    Colorizes 4 band tiles (griz, uint8 arrays) into an rgb tile, with integer arithmetic.
+
+    The median of the 4 bands is half the sum of the middle two, which is the total less the minimum and maximum, 
+    so a band pixel of 255 is more than maxDif above the median when the middle two sum to less than 
+    2*(255 - maxDif). The channels are the integer (floor) means.
+
+    Returns
+    -------
+    The rgb tile (uint8 array), in the same order as the colorizing algorithm (R, G, B).
+    """
+
+    total = g.astype(np.uint16) + r + i + z
+    middle = total - np.minimum(np.minimum(g,r),np.minimum(i,z)) - np.maximum(np.maximum(g,r),np.maximum(i,z))
+    low = middle < 2*(255 - maxDif)
+    g, r, i, z = [np.where(low & (band == 255), 0, band).astype(np.uint16) for band in (g,r,i,z)]
+
+    rgb = np.empty(g.shape + (3,), dtype=np.uint8)
+    rgb[...,0] = (i + z)//2
+    rgb[...,1] = (2*r + i)//3
+    rgb[...,2] = (2*g + r)//3
+    return rgb
+
+
 def colorize(depth,dirBase,outDir,txrange,tyrange,restart = False):
     """
     Colorizes 4 TOASTED wavebands (griz) into rgb images.
@@ -40,27 +71,28 @@ def colorize(depth,dirBase,outDir,txrange,tyrange,restart = False):
       directory in which the colorized tiles will be places 
       (within numbered layer directory)
     txrange/tyrange: array
-      x and y ranges of tiles to colorize in the form [min,max]
+      x and y ranges of tiles to colorize in the form [min,max] (the tiles that exist are found by scanning
+      the layers' directories, see psTiles.existingTiles)
     restart: boolean (default False)
       If true, tiles which already exist in the colorized directory will no be re-colorized
     """
-    for tx,ty in product(range(*txrange),range(*tyrange)):
-        pth = '/' + str(depth) + '/' + str(ty) + '/' + str(ty) + '_' + str(tx) + '.png'
 
-        # checking if the color file already exists
-        if os.path.isfile(outDir+pth):
-            if restart: 
-                continue
-            else:
-                os.remove(outDir+pth)
-
-        
-        # check we have all the files we need
-        if not (os.path.isfile(dirBase+'g'+pth) and os.path.isfile(dirBase+'r'+pth) 
-                and os.path.isfile(dirBase+'i'+pth) and os.path.isfile(dirBase+'z'+pth)):
-                #and os.path.isfile(dirBase+'y'+pth)):
-            continue
-        
+    # the tiles we have all the files for
+    tiles = psTiles.existingTiles(dirBase+'g',depth,txrange,tyrange)
+    for band in 'riz': # (final colorizing does not use y)
+        tiles &= psTiles.existingTiles(dirBase+band,depth,txrange,tyrange)
+
+    # checking if the color files already exist
+    colorTiles = psTiles.existingTiles(outDir,depth,txrange,tyrange)
+    if restart:
+        tiles -= colorTiles
+    else:
+        for tx,ty in colorTiles:
+            os.remove(outDir + '/' + str(depth) + '/' + str(ty) + '/' + str(ty) + '_' + str(tx) + '.png')
+
+    madeDirs = set()
+    for tx,ty in sorted(tiles, key=lambda tile: tile[::-1]):
+        pth = '/' + str(depth) + '/' + str(ty) + '/' + str(ty) + '_' + str(tx) + '.png'
         
         g = imread(dirBase+'g'+pth)
         r = imread(dirBase+'r'+pth)
@@ -68,28 +100,12 @@ def colorize(depth,dirBase,outDir,txrange,tyrange,restart = False):
         z = imread(dirBase+'z'+pth)
         #y = imread(dirBase+'y'+pth) (final colorizing does not use y)
          
-        G = g.astype(np.float64)
-        R = r.astype(np.float64)
-        I = i.astype(np.float64)
-        Z = z.astype(np.float64)
-        #Y = y.astype(np.float64)
-        
-        # bad pixels will be sturated in only one band (hopefully)
-        maxDif = 175
-        PM = np.median(np.array([G,R,I,Z]), axis=0)
-        g[((G - PM) > maxDif) & (g == 255)] = 0
-        r[((R - PM) > maxDif) & (r == 255)] = 0
-        i[((I - PM) > maxDif) & (i == 255)] = 0
-        z[((Z - PM) > maxDif) & (z == 255)] = 0
-        #y[((Y - PM) > maxDif) & (y == 255)] = 0
-        
-        rgb = np.dstack((np.mean(np.array([i,z]),axis=0).astype(np.uint8),
-                         np.mean(np.array([r,r,i]),axis=0).astype(np.uint8),
-                         np.mean(np.array([g,g,r]),axis=0).astype(np.uint8)))
+        rgb = colorizeBands(g,r,i,z)
 
         direc, _ = os.path.split(outDir+pth)
-        if not os.path.exists(direc):
-            os.makedirs(direc)
+        if direc not in madeDirs:
+            os.makedirs(direc, exist_ok=True)
+            madeDirs.add(direc)
 
         try:
             imsave(outDir+pth, rgb)
@@ -189,11 +205,11 @@ if __name__ == "__main__":
         
     maxTileDim = 2**depth
     if not txRange:
-        txRange = maxTileDim
+        txRange = [0,maxTileDim]
     if not tyRange:
-        tyRange = maxTileDim
+        tyRange = [0,maxTileDim]
 
-    if (depth > 8) and  (txRange == maxTileDim) and (tyRange == maxTileDim):
+    if (depth > 8) and  (txRange == [0,maxTileDim]) and (tyRange == [0,maxTileDim]):
         print("You have requested colorization of all tiles at depth %d." % depth)
         print("This may take a while, please be patient, or start with a smaller section.")
 
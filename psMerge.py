@@ -1,15 +1,35 @@
 #!/usr/bin/env python
 
-import sys, getopt
+import sys, getopt, os
 
 import numpy as np
 
 import time
 
+from collections import namedtuple
+
 from toasty import toast
 
+import PIL
 from PIL import Image
 
+import psTiles
+from psSmoothing import despeckleImage, despeckleArray
+
+Settings = namedtuple('Settings','bicubic smooth enhance threshold')
+
+# the merge and de-speckle settings of each level found to work best for the colorized tiles
+# (levels not listed are merged bicubically with no de-speckling)
+levelSettings = {11: Settings(bicubic=True, smooth=False, enhance=False, threshold=True),
+                 10: Settings(bicubic=True, smooth=False, enhance=False, threshold=True),
+                 9: Settings(bicubic=True, smooth=True, enhance=True, threshold=True),
+                 8: Settings(bicubic=True, smooth=True, enhance=True, threshold=True),
+                 7: Settings(bicubic=True, smooth=True, enhance=True, threshold=True),
+                 6: Settings(bicubic=False, smooth=True, enhance=True, threshold=True),
+                 5: Settings(bicubic=False, smooth=False, enhance=True, threshold=True),
+                 4: Settings(bicubic=False, smooth=False, enhance=True, threshold=True)}
+defaultSettings = Settings(bicubic=True, smooth=False, enhance=False, threshold=False)
+
 def mergeBicubic(mosaic):
     """Bicubic merge function for toasty merging."""
     subtile = Image.fromarray(mosaic)
@@ -17,13 +37,147 @@ def mergeBicubic(mosaic):
     return np.asarray(subtile)
 
 def mergeNearsetNeighbor(mosaic):
-    """Nearest neighbor merge function for toasty merging."""
+    """Nearest neighbor merge function for toasty merging.
+    This is PIL's default resize, which has been bicubic since Pillow 7 (see mergeNearest)."""
     subtile = Image.fromarray(mosaic)
     subtile = subtile.resize((256,256))
     return np.asarray(subtile)
 
+def mergeNearest(mosaic):
+    """True nearest neighbor merge function for toasty merging (the opt-in trueNearest option)."""
+    subtile = Image.fromarray(mosaic)
+    subtile = subtile.resize((256,256),Image.NEAREST)
+    return np.asarray(subtile)
+
+
+# PIL's fixed point precision for resampling 8 bit images
+precisionBits = 32 - 8 - 2
+
+
+def _imageAxes(mosaics):
+    """Returns the (row, column) axes of the image(s) mosaics: the last two, or the two before the last 
+    if it is an RGB colour axis (of 3 channels).
+
+    Mosaics with an alpha channel (2 or 4 channels) are not supported, as PIL premultiplies the alpha when 
+    resizing them, which the array merges do not do (they are merged with the pil engine)."""
+    if (mosaics.ndim > 2) and (mosaics.shape[-1] in (2, 4)):
+        raise ValueError("Mosaics with an alpha channel can only be merged with the pil engine")
+    if (mosaics.ndim > 2) and (mosaics.shape[-1] == 3):
+        return mosaics.ndim - 3, mosaics.ndim - 2
+    return mosaics.ndim - 2, mosaics.ndim - 1
+
+
+def _bicubicCoeffs(inSize, outSize):
+    """
+    Returns the (index, weight) arrays (outSize x taps) of PIL's bicubic resampling from inSize to outSize pixels, 
+    with the weights in fixed point (precisionBits), as PIL computes them. Taps past the edge have weight 0.
+    """
+
+    def bicubic(x, a=-0.5):
+        x = np.abs(x)
+        return np.where(x < 1, ((a + 2)*x - (a + 3))*x*x + 1, 
+                        np.where(x < 2, (((x - 5)*x + 8)*x - 4)*a, 0))
+
+    scale = inSize / outSize
+    support = 2*max(scale, 1)
+    taps = int(np.ceil(support))*2 + 1
+    center = (np.arange(outSize) + 0.5)*scale
+    xmin = np.maximum((center - support + 0.5).astype(int), 0)
+    xmax = np.minimum((center + support + 0.5).astype(int), inSize)
+    index = xmin[:,None] + np.arange(taps)
+    valid = index < xmax[:,None]
+    weight = np.where(valid, bicubic((index - center[:,None] + 0.5) / max(scale, 1)), 0)
+    weight /= weight.sum(axis=1, keepdims=True)
+    fixed = np.where(weight < 0, -0.5, 0.5) + weight*(1 << precisionBits)
+    return np.where(valid, index, 0), np.trunc(fixed).astype(np.int64)
+
+
+def _halveAxis(imgs, axis):
+    """Returns imgs (uint8) resampled bicubically along axis to half the pixels, rounded and clipped to uint8 as 
+    PIL does.
+
+    Output pixel i is a weighted sum of the input pixels 2i-pad to 2i-pad+taps-1 (the weights only differ near 
+    the edges, where PIL's window is cut short), so each tap is a stride 2 view of the (zero padded) input.
+    """
+    outSize = imgs.shape[axis]//2
+    index, weight = _bicubicCoeffs(imgs.shape[axis], outSize)
+    offset = index - 2*np.arange(outSize)[:,None]
+    pad = max(-int(offset[weight != 0].min()), 0)
+    taps = int(offset[weight != 0].max()) + pad + 1
+
+    # the weights by tap
+    tapWeights = np.zeros((outSize, taps), dtype=np.int32)
+    rows = np.broadcast_to(np.arange(outSize)[:,None], index.shape)
+    used = weight != 0
+    tapWeights[rows[used], offset[used] + pad] = weight[used]
+
+    widths = [(0, 0)]*imgs.ndim
+    widths[axis] = (pad, max(2*outSize + taps - pad - 2 - imgs.shape[axis], 0) + 1)
+    padded = np.pad(imgs, widths)
+    shape = [1]*imgs.ndim
+    shape[axis] = outSize
+    view = [slice(None)]*imgs.ndim
+    total = np.full(imgs.shape[:axis] + (outSize,) + imgs.shape[axis+1:], 1 << (precisionBits - 1), dtype=np.int32)
+    product = np.empty_like(total)
+    for tap in range(taps):
+        view[axis] = slice(tap, tap + 2*outSize, 2)
+        np.multiply(padded[tuple(view)], tapWeights[:,tap].reshape(shape), out=product)
+        total += product
+    return np.clip(total >> precisionBits, 0, 255).astype(np.uint8)
+
+
+def bicubicDownsample(mosaics):
+    """
+    Bicubic merge function working on arrays: halves the size of a mosaic, or a batch of them (stacked along 
+    the leading axes), giving the same result as mergeBicubic (PIL's bicubic resize).
+
+    As PIL does, the mosaics are resampled horizontally (to 8 bit intermediate values), then vertically, with 
+    a bicubic kernel (a = -0.5) widened to the 2x reduction, in fixed point.
+    """
+    rowAxis, colAxis = _imageAxes(mosaics)
+    if colAxis == mosaics.ndim - 1:
+        return _halveAxis(_halveAxis(mosaics, colAxis), rowAxis)
+    # resampling each colour plane (contiguous) separately is much quicker
+    planes = np.ascontiguousarray(np.moveaxis(mosaics, -1, 0))
+    return np.ascontiguousarray(np.moveaxis(_halveAxis(_halveAxis(planes, colAxis + 1), rowAxis + 1), 0, -1))
+
+
+def nearestDownsample(mosaics):
+    """Nearest neighbor merge function working on arrays: halves the size of a mosaic, or a batch of them, 
+    giving the same result as mergeNearest (PIL keeps the odd pixels)."""
+    rowAxis, colAxis = _imageAxes(mosaics)
+    index = [slice(None)]*mosaics.ndim
+    index[rowAxis] = index[colAxis] = slice(1, None, 2)
+    return np.ascontiguousarray(mosaics[tuple(index)])
+
+
+def boxDownsample(mosaics):
+    """Area average merge function working on arrays: halves the size of a mosaic, or a batch of them, 
+    each pixel being the (rounded) mean of the 2x2 pixels it covers."""
+    rowAxis, colAxis = _imageAxes(mosaics)
+    shape = mosaics.shape
+    # adding the pairs of rows, then the pairs of columns, each being contiguous blocks
+    pairs = mosaics.reshape(shape[:rowAxis] + (shape[rowAxis]//2, 2, -1))
+    rows = pairs[..., 0, :].astype(np.uint16) + pairs[..., 1, :]
+    pairs = rows.reshape(shape[:rowAxis] + (shape[rowAxis]//2, shape[colAxis]//2, 2) + shape[colAxis+1:])
+    total = pairs.take(0, axis=colAxis + 1) + pairs.take(1, axis=colAxis + 1)
+    return ((total + 2) // 4).astype(mosaics.dtype)
+
+
+# PIL's default resize filter (used by mergeNearsetNeighbor) is bicubic from Pillow 7
+defaultBicubic = int(PIL.__version__.split('.')[0]) >= 7
 
-def psMerge(baseDir,depth, topLevel, toastTile, bicubicMerge):
+# the (bicubic, nearest neighbor) merge functions of each merge engine, the array engines resample
+# as mergeNearsetNeighbor does with the installed PIL
+mergeEngines = {'pil': (mergeBicubic, mergeNearsetNeighbor),
+                'numpy': (bicubicDownsample, bicubicDownsample if defaultBicubic else nearestDownsample),
+                'box': (boxDownsample, boxDownsample if defaultBicubic else nearestDownsample)}
+
+# the true nearest neighbor merge function of each merge engine (see trueNearest)
+nearestMerges = {'pil': mergeNearest, 'numpy': nearestDownsample, 'box': nearestDownsample}
+
+
+def psMerge(baseDir,depth, topLevel, toastTile, bicubicMerge, mergeEngine='pil', trueNearest=False):
     """Create a full hierarchical TOAST tileset up to topLevel from a baseLayer of TOAST tiles.
 
     Parameters
@@ -38,18 +192,133 @@ def psMerge(baseDir,depth, topLevel, toastTile, bicubicMerge):
       Only tiles that overlap with this TOAST tile will be merged. Form [depth,tx,ty].
     bicubicMerge: boolean 
       If True, bicubic merge will be used, otherwise nearest neighbor will be used.
+    mergeEngine: string (default 'pil')
+      The merge functions used (see mergeEngines): 'pil' (PIL resizing), 'numpy' (the same resampling on arrays),
+      or 'box' (area averaging in place of bicubic, on arrays).
+    trueNearest: boolean (default False)
+      If True, the nearest neighbor merge is done with true nearest neighbor resampling (see nearestMerges), 
+      rather than PIL's default resize filter (bicubic since Pillow 7), which the existing tile sets were made with.
 
     """
 
     if bicubicMerge == True:
-        imgMerge = mergeBicubic
+        imgMerge = mergeEngines[mergeEngine][0]
+    elif trueNearest:
+        imgMerge = nearestMerges[mergeEngine]
     else:
-        imgMerge = mergeNearsetNeighbor
+        imgMerge = mergeEngines[mergeEngine][1]
     toast(baseDir,depth,baseDir,top_layer=topLevel,merge=imgMerge,toast_tile=toastTile) 
 
+
+def readTile(pth):
+    """Returns the tile image at pth as an array, or None if it does not exist (or cannot be read)."""
+    if not os.path.isfile(pth):
+        return None
+    try:
+        return np.asarray(Image.open(pth))
+    except:
+        print("Problem with " + pth)
+        return None
+
+
+def mosaic(children):
+    """Returns the mosaic of the 4 children of a tile, given in the order (2x,2y), (2x+1,2y), (2x,2y+1), (2x+1,2y+1)
+    (missing children, None, are left black), or None if they are all missing."""
+    present = [child for child in children if child is not None]
+    if not present:
+        return None
+    size = present[0].shape[0]
+    img = np.zeros((2*size, 2*size) + present[0].shape[2:], dtype=present[0].dtype)
+    for idx, child in enumerate(children):
+        if child is not None:
+            row, col = divmod(idx, 2)
+            img[row*size:(row + 1)*size, col*size:(col + 1)*size] = child
+    return img
+
+
+def buildTile(baseDir, depth, n, x, y, settings, mergeEngine='pil', trueNearest=False, levelTiles=None):
+    """Returns tile (n, x, y) (as an array, None if it has no data), reading it from baseDir if n is depth,
+    otherwise building it from its children, which are built (recursively) in memory. Built tiles are saved.
+
+    If levelTiles (a dictionary of the set of (x, y) of each level that have base layer tiles under them, 
+    see baseLevelTiles) is given, the tiles not in it are skipped without looking for their files."""
+
+    if (levelTiles is not None) and ((x, y) not in levelTiles[n]):
+        return None
+
+    if n == depth:
+        return readTile(psTiles.tilePath(baseDir, n, x, y))
+
+    img = mosaic([buildTile(baseDir, depth, n + 1, 2*x + dx, 2*y + dy, settings, mergeEngine, trueNearest, levelTiles) 
+                  for dy in (0, 1) for dx in (0, 1)])
+    if img is None:
+        return None
+
+    levelSet = settings.get(n, defaultSettings)
+    bicubicMerge, nearestMerge = mergeEngines[mergeEngine]
+    if trueNearest:
+        nearestMerge = nearestMerges[mergeEngine]
+    img = bicubicMerge(img) if levelSet.bicubic else nearestMerge(img)
+    if levelSet.smooth or levelSet.enhance or levelSet.threshold:
+        if mergeEngine == 'pil':
+            img = np.asarray(despeckleImage(Image.fromarray(img), levelSet.threshold, levelSet.smooth, levelSet.enhance))
+        else:
+            img = despeckleArray(img, levelSet.threshold, levelSet.smooth, levelSet.enhance)
+    psTiles.saveTile(img, psTiles.tilePath(baseDir, n, x, y))
+    return img
+
+
+def baseLevelTiles(baseDir, depth, topLevel, txrange=None, tyrange=None):
+    """Returns a dictionary of the set of (x, y) of the tiles of each level from depth up to topLevel that have 
+    base layer (depth) tiles under them, the base layer tiles (within txrange and tyrange) being found 
+    with psTiles.existingTiles."""
+    levelTiles = {depth: psTiles.existingTiles(baseDir, depth, txrange, tyrange)}
+    for n in range(depth - 1, topLevel - 1, -1):
+        levelTiles[n] = {(x >> 1, y >> 1) for x, y in levelTiles[n + 1]}
+    return levelTiles
+
+
+def psPyramid(baseDir, depth, topLevel, toastTile=None, settings=levelSettings, mergeEngine='pil', trueNearest=False):
+    """Create the levels from depth-1 up to topLevel of a TOAST tileset from a base layer of TOAST tiles, 
+    merging and de-speckling each level with its own settings, in one traversal.
+
+    Each subtree is built depth first in memory, so tiles are read from disk only at the base layer, 
+    and each new tile is written once (already de-speckled). The base layer tiles are listed first 
+    (see baseLevelTiles), and subtrees with none are skipped.
+
+    Parameters
+    ---------- 
+    baseDir: string
+      The upper level directory that contains the TOASTed tiles by layer.
+    depth: int
+      The depth of the bottommost layer you want to merge from (these tiles should already exist).
+    topLevel: int
+      The topmost layer you want to merge to.
+    toastTile: array (default None)
+      Only tiles within this TOAST tile will be made. Form [depth,tx,ty]. 
+      If it is deeper than topLevel, only the levels from its depth down are made (the levels above need 
+      tiles outside it).
+    settings: dictionary (default levelSettings)
+      The Settings (bicubic, smooth, enhance, threshold) of each level, levels not in it are merged bicubically 
+      with no de-speckling.
+    mergeEngine: string (default 'pil')
+      The merge functions used (see mergeEngines), with the 'numpy' and 'box' engines tiles are also de-speckled
+      on arrays (psSmoothing.despeckleArray, giving the same result as despeckleImage).
+    trueNearest: boolean (default False)
+      As for psMerge.
+    """
+
+    tileDepth, tx, ty = toastTile if toastTile else (0, 0, 0)
+    rootLevel = max(topLevel, tileDepth)
+    shift = depth - tileDepth
+    levelTiles = baseLevelTiles(baseDir, depth, rootLevel, [tx << shift, (tx + 1) << shift], 
+                                [ty << shift, (ty + 1) << shift])
+    for x, y in sorted(levelTiles[rootLevel]):
+        buildTile(baseDir, depth, rootLevel, x, y, settings, mergeEngine, trueNearest, levelTiles)
+
     
 def usage():
-    print("psMerge.py -b <base directory> -d <depth> [-l <top level> -t <tile> -c]")
+    print("psMerge.py -b <base directory> -d <depth> [-l <top level> -t <tile> -c -p -e <merge engine> -n]")
     print(
     """Create a full hierarchical TOAST tileset up to topLevel from a baseLayer of TOAST tiles.
 
@@ -65,6 +334,15 @@ def usage():
       Only tiles that overlap with this TOAST tile will be merged. Form depth,tx,ty.
     bicubicMerge (c): boolean (optional)
       If True, bicubic merge will be used, otherwise nearest neighbor will be used.
+    pyramid (p): boolean (optional)
+      If True, all the levels are made in one traversal, in memory, each merged and de-speckled with its
+      own settings (see levelSettings), and bicubicMerge is ignored.
+    mergeEngine (e): string (optional)
+      The merge functions used: pil (default, PIL resizing), numpy (the same resampling done on arrays, 
+      giving the same tiles), or box (2x2 area averaging in place of bicubic, on arrays).
+    trueNearest (n): boolean (optional)
+      If True, nearest neighbor merges use true nearest neighbor resampling rather than PIL's default 
+      resize filter (bicubic since Pillow 7).
     """)
     
 
@@ -72,7 +350,8 @@ def usage():
 if __name__ == "__main__":
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:],"hb:d:l:t:c",["help","basedir=","depth=","toplevel=","tile=","bicubic"])
+        opts, args = getopt.getopt(sys.argv[1:],"hb:d:l:t:cpe:n",["help","basedir=","depth=","toplevel=","tile=","bicubic","pyramid",
+                                                               "engine=","nearest"])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -83,6 +362,9 @@ if __name__ == "__main__":
     topLevel = 4 # default is 4, since that works for AstroView
     toastTile = None
     bicubic=False
+    pyramid=False
+    mergeEngine='pil'
+    trueNearest=False
 
     for opt, arg in opts:
         if opt in ('-h','--help'):
@@ -113,6 +395,15 @@ if __name__ == "__main__":
                 sys.exit(2)
         if opt in ('-c','--bicubic'):
             bicubic = True
+        if opt in ('-p','--pyramid'):
+            pyramid = True
+        if opt in ('-e','--engine'):
+            mergeEngine = arg
+            if mergeEngine not in mergeEngines:
+                print("Merge engine must be one of: " + ", ".join(mergeEngines))
+                sys.exit(2)
+        if opt in ('-n','--nearest'):
+            trueNearest = True
             
 
     if not baseDir:
@@ -126,7 +417,10 @@ if __name__ == "__main__":
         sys.exit(2)        
 
     start = time.time()
-    psMerge(baseDir,depth,topLevel,toastTile,bicubic)
+    if pyramid:
+        psPyramid(baseDir,depth,topLevel,toastTile,mergeEngine=mergeEngine,trueNearest=trueNearest)
+    else:
+        psMerge(baseDir,depth,topLevel,toastTile,bicubic,mergeEngine,trueNearest)
     end = time.time()
     print(end-start)
 
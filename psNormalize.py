@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+"""Normalization of panstarrs skycell images.
+
+The limits are the average of the 0.5 percentile of the pixels below the image mean and -1.3 (vmin),
+and of the 99.5 percentile of the pixels above the image mean and 4.3 (vmax), and a sinh stretch
+is applied between them, with nans set to vmax.
+"""
+
+import sys, getopt, os
+
+import numpy as np
+
+import csv
+import sqlite3
+import threading
+import time
+
+from toasty.norm import normalize
+
+# normalization engines: 'toasty' applies toasty's normalize to the whole image,
+# 'fused' fills the nans and applies the same stretch block by block, in place
+engines = ('toasty','fused')
+
+# number of pixels stretched at a time by the fused engine (a float64 block this size fits in cache)
+blockSize = 2**16
+
+# number of pixels sampled to bracket the percentiles
+sampleSize = 2**20
+
+
+def _percentileOfSorted(lower, upper, count, q):
+    """Returns the q percentile of count values ('linear' method, as np.percentile) given
+    the values lower and upper at the two sorted positions around it."""
+    virtIdx = (count - 1) * (q / 100)
+    # interpolating with numpy's own rule, so the result is the same as np.percentile on the full set
+    return np.quantile(np.array([lower, upper]), virtIdx - np.floor(virtIdx))
+
+
+def _orderStats(flat, nValid, ranks):
+    """Returns the values at the given (sorted, 0-based) ranks of the non-nan values of flat.
+
+    Rather than partitioning a copy of the whole image, thresholds that bracket the wanted ranks
+    are estimated from a sample, and only the pixels beyond them are copied and partitioned.
+    If a threshold turns out not to bracket its ranks the full set of pixels is used."""
+
+    sample = flat[::max(1, len(flat)//sampleSize)]
+    sample = np.sort(sample[~np.isnan(sample)])
+    margin = 2*len(sample)/nValid
+
+    values = {}
+    lowRanks = [r for r in ranks if r < nValid/2]
+    highRanks = [r for r in ranks if r >= nValid/2]
+
+    if lowRanks:
+        thresh = sample[min(int(max(lowRanks)*margin) + 64, len(sample) - 1)]
+        cands = flat[flat <= thresh]
+        if len(cands) > max(lowRanks):
+            cands.partition(lowRanks)
+            values.update((r, cands[r]) for r in lowRanks)
+    if highRanks:
+        thresh = sample[max(len(sample) - 1 - int((nValid - min(highRanks))*margin) - 64, 0)]
+        cands = flat[flat >= thresh]
+        offset = nValid - len(cands)
+        if offset <= min(highRanks):
+            cands.partition([r - offset for r in highRanks])
+            values.update((r, cands[r - offset]) for r in highRanks)
+
+    missing = [r for r in ranks if r not in values]
+    if missing:
+        data = flat[~np.isnan(flat)]
+        data.partition(missing)
+        values.update((r, data[r]) for r in missing)
+    return [values[r] for r in ranks]
+
+
+def skycellLimits(imgData, subsample=1):
+    """
+    Compute the normalization limits of a skycell image.
+
+    Gives the same vmin, vmax as taking np.percentile of boolean masked copies of the pixels
+    below and above the mean. The pixels <= the mean are the smallest of all the (non-nan) pixels,
+    and the pixels >= the mean the largest, so both percentiles are order statistics of the full set,
+    which are found without copying or sorting the image (see _orderStats).
+
+    Parameters
+    ----------
+    imgData: array
+      The skycell image (nans are ignored).
+    subsample: int (default 1)
+      If greater than 1, the limits are taken from every subsample-th pixel only.
+      This is faster, but the limits are then approximate.
+
+    Returns
+    -------
+    (vmin, vmax)
+
+    Raises ValueError if there are no valid (non-nan) pixels (to take the limits from).
+    """
+
+    flat = imgData.reshape(-1)
+    if subsample > 1:
+        flat = np.ascontiguousarray(flat[::subsample])
+
+    # mean of the non-nan pixels, computed the same way as np.nanmean
+    nanMask = np.isnan(flat)
+    nValid = len(flat) - np.count_nonzero(nanMask)
+    if nValid == 0:
+        raise ValueError("No valid pixels to compute the normalization limits from")
+    tot = np.sum(np.where(nanMask, 0, flat) if nValid < len(flat) else flat)
+    imean = tot.dtype.type(tot / nValid)
+    del nanMask
+
+    nLow = np.count_nonzero(flat <= imean)
+    nHigh = np.count_nonzero(flat >= imean)
+
+    # sorted positions of the values either side of each percentile
+    lowIdx = int(np.floor((nLow - 1) * 0.005))
+    highIdx = nValid - nHigh + int(np.floor((nHigh - 1) * 0.995))
+    ranks = [lowIdx, min(lowIdx + 1, nLow - 1), highIdx, min(highIdx + 1, nValid - 1)]
+    values = _orderStats(flat, nValid, ranks)
+
+    vmin = (_percentileOfSorted(values[0], values[1], nLow, 0.5) - 1.3) / 2
+    vmax = (_percentileOfSorted(values[2], values[3], nHigh, 99.5) + 4.3) / 2
+    return vmin, vmax
+
+
+def sinhStretch(imgData, vmin, vmax, bias=0.5, contrast=1):
+    """
+    Apply the sinh stretch of toasty.norm.normalize(imgData, vmin, vmax, bias, contrast, stretch='sinh'),
+    with nans set to vmax, one cache sized block at a time, in place.
+
+    The stretch is computed in the type numpy gives toasty's arithmetic (imgData - vmin), so float32 images
+    are stretched in float32 (with numpy 1.x) as toasty does, and the result is the same as toasty's.
+
+    Returns
+    -------
+    The stretched image (values 0-255).
+    """
+
+    flat = imgData.reshape(-1)
+    outData = np.empty(imgData.shape, dtype=np.result_type(imgData, vmin))
+    out = outData.reshape(-1)
+    fill = imgData.dtype.type(vmax)
+
+    for start in range(0, len(flat), blockSize):
+        src = flat[start:start + blockSize]
+        np.copyto(src, fill, where=np.isnan(src))
+        blk = out[start:start + blockSize]
+        np.subtract(src, vmin, out=blk)
+        np.divide(blk, vmax - vmin, out=blk)
+        np.clip(blk, 0, 1, out=blk)
+        np.multiply(blk, 3, out=blk)
+        np.sinh(blk, out=blk)
+        np.divide(blk, 10, out=blk)
+        np.subtract(blk, bias, out=blk)
+        np.multiply(blk, contrast, out=blk)
+        np.add(blk, 0.5, out=blk)
+        np.clip(blk, 0, 1, out=blk)
+        np.multiply(blk, 255, out=blk)
+    return outData
+
+
+def normalizeSkycell(imgData, engine='toasty', subsample=1, limits=None):
+    """
+    Normalize a skycell image with a sinh stretch.
+
+    Parameters
+    ----------
+    imgData: array
+      The skycell image, nans are set to vmax (this may modify imgData).
+    engine: string (default 'toasty')
+      'toasty' uses toasty.norm.normalize, 'fused' uses sinhStretch, which does the nan fill and
+      stretch with no full size temporaries (see psBenchmark.py for the comparison of the two).
+    subsample: int (default 1)
+      Passed to skycellLimits.
+    limits: tuple (default None)
+      Precomputed (vmin, vmax), if not given they are computed with skycellLimits.
+
+    Returns
+    -------
+    The normalized image (values 0-255).
+    """
+
+    if engine not in engines:
+        raise ValueError("Normalization engine must be one of: " + ", ".join(engines))
+
+    vmin, vmax = limits if limits else skycellLimits(imgData, subsample)
+
+    if engine == 'toasty':
+        imgData[np.isnan(imgData)] = vmax
+        return normalize(imgData,vmin,vmax,stretch='sinh')
+    return sinhStretch(imgData, vmin, vmax)
+
+
+class statsCatalog:
+    """Catalog of skycell normalization limits, kept in a sqlite database keyed by file path, size, and mtime
+    (so limits are recomputed if a file changes). The database can be shared by any number of processes, 
+    and a catalog object by any number of threads (each has its own connection)."""
+
+    columns = ('file', 'size', 'mtime', 'subsample', 'vmin', 'vmax')
+
+    def __init__(self,dbFile):
+        """Opens (creating if needed) the catalog database dbFile."""
+        self.dbFile = dbFile
+        self.local = threading.local()
+        self.connect().execute("""CREATE TABLE IF NOT EXISTS limits (file TEXT, size INTEGER, mtime INTEGER, 
+                                  subsample INTEGER, vmin REAL, vmax REAL, PRIMARY KEY (file, subsample))""")
+
+    def connect(self):
+        """Returns this thread's database connection, (re)connecting if needed (sqlite connections cannot be 
+        used from other threads, and are not shared across fork)."""
+        if getattr(self.local,'pid',None) != os.getpid():
+            self.local.db = sqlite3.connect(self.dbFile,timeout=600,isolation_level=None)
+            self.local.pid = os.getpid()
+        return self.local.db
+
+    def get(self,filename,subsample=1):
+        """Returns the stored (vmin, vmax) for the file 'filename', or None if they are not stored 
+        or the file has changed since they were."""
+        st = os.stat(filename)
+        row = self.connect().execute("SELECT vmin, vmax FROM limits WHERE file=? AND subsample=? AND size=? AND mtime=?",
+                                     (os.path.abspath(filename), subsample, st.st_size, st.st_mtime_ns)).fetchone()
+        return row
+
+    def put(self,filename,limits,subsample=1):
+        """Stores the (vmin, vmax) limits for the file 'filename'."""
+        st = os.stat(filename)
+        self.connect().execute("INSERT OR REPLACE INTO limits VALUES (?,?,?,?,?,?)",
+                               (os.path.abspath(filename), st.st_size, st.st_mtime_ns, subsample, 
+                                float(limits[0]), float(limits[1])))
+
+    def export(self,outFile):
+        """Writes the catalog as a CSV file with columns file, size, mtime, subsample, vmin, and vmax."""
+        with open(outFile,'w',newline='') as fle:
+            writer = csv.writer(fle)
+            writer.writerow(self.columns)
+            writer.writerows(self.connect().execute("SELECT %s FROM limits ORDER BY file" % ", ".join(self.columns)))
+
+
+def precomputeStats(filePths, stats, subsample=1):
+    """
+    Compute and store the normalization limits of skycell files not already in the stats catalog.
+
+    Parameters
+    ----------
+    filePths: list
+      The skycell FITS files.
+    stats: statsCatalog
+      The catalog the limits are stored in.
+    subsample: int (default 1)
+      Passed to skycellLimits.
+
+    Returns
+    -------
+    The number of files whose limits were computed.
+    """
+
+    from astropy.io import fits
+
+    count = 0
+    for filename in filePths:
+        try:
+            if stats.get(filename,subsample):
+                continue
+            fitsfile = fits.open(filename)
+            imgData = fitsfile[1].data
+            fitsfile.close()
+            stats.put(filename,skycellLimits(imgData,subsample),subsample)
+            count += 1
+        except: # Any problem with opening or reading, the file is skipped as it would be when toasting
+            print("Problem with " + filename)
+    return count
+
+
+def usage():
+    print("psNormalize.py -s <statsfile> [-i <inputfile>] [-p <subsample>] [-e <exportfile>]")
+    print("""
+    Precompute skycell normalization limits into a stats catalog (as used by psTOAST.py -c), 
+    and/or export the catalog as CSV.
+
+    Parameters
+    ----------
+    statsFile (-s): string
+      The stats catalog (sqlite database) file, created if it does not exist.
+    inputFile (-i): string (optional)
+      Panstarrs skycell file location catalog (filter_*_rings.rpt file or compiled .npz),
+      the limits of all its files that are not already in the stats catalog are computed.
+    subsample (-p): int (optional)
+      If greater than 1 the limits are computed from every subsample-th pixel (must match the toasting option).
+    exportFile (-e): string (optional)
+      CSV file the stats catalog is written to.
+    """)
+
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:],"hs:i:p:e:",["help","stats=","inputfile=","subsample=","export="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    statsFile = ''
+    inputFile = ''
+    subsample = 1
+    exportFile = ''
+
+    for opt, arg in opts:
+        if opt in ('-h','--help'):
+            usage()
+            sys.exit()
+        if opt in ('-s','--stats'):
+            statsFile = arg
+        if opt in ('-i','--inputfile'):
+            inputFile = arg
+        if opt in ('-p','--subsample'):
+            try:
+                subsample = int(arg)
+            except ValueError:
+                print("Subsample must be an integer")
+                sys.exit(2)
+        if opt in ('-e','--export'):
+            exportFile = arg
+
+    if not statsFile:
+        print("Stats file is a required argument.")
+        usage()
+        sys.exit(2)
+
+    start = time.time()
+    stats = statsCatalog(statsFile)
+    if inputFile:
+        from psCatalog import readCatalog
+        _, filePths = readCatalog(inputFile)
+        print("Computed limits for %d files" % precomputeStats(filePths,stats,subsample))
+    if exportFile:
+        stats.export(exportFile)
+    end = time.time()
+    print(end - start)
@@ -12,52 +12,169 @@ from itertools import product
 
 from PIL import Image, ImageEnhance, ImageFilter
 
+import psTiles
+
 thresh = 40
+enhancement = 1.1
+
+# the de-speckling engines: PIL and cv2 ('pil', despeckleImage), or array lookups ('numpy', despeckleArray)
+engines = ('pil','numpy')
+
+
+def despeckleImage(img,threshold=True,smooth=True,enhance=True):
+    """
+    De-speckle a tile image.
+
+    Parameters
+    ----------
+    img: PIL Image
+      The tile image.
+    threshold: boolean (default True)
+      If True, values of thresh (40) or less are set to zero.
+    smooth: boolean (default True)
+      If True, PIL's ImageFilter.SMOOTH is applied.
+    enhance: boolean (default True)
+      If True, the brightness and contrast are increased by 10%.
+
+    Returns
+    -------
+    The de-speckled image (PIL Image).
+    """
+
+    if smooth == True:
+        cleanImg = img.filter(ImageFilter.SMOOTH)
+    else:
+        cleanImg = img
+
+    if enhance == True:
+        brightness = ImageEnhance.Brightness(cleanImg)
+        cleanImg = brightness.enhance(enhancement)
+
+        contrast = ImageEnhance.Contrast(cleanImg)
+        cleanImg = contrast.enhance(enhancement)
+
+    if threshold == True:
+        retval, cleanImg = cv2.threshold(np.array(cleanImg), thresh, 255, cv2.THRESH_TOZERO)
+        cleanImg = Image.fromarray(cleanImg)
+
+    return cleanImg
+
+
+def _blendTable(degenerate, factor):
+    """Returns the lookup table (uint8 values 0-255) of PIL's Image.blend(degenerate, img, factor) with a constant 
+    degenerate image, which for factor > 1 is computed in single precision, then clipped and truncated."""
+    values = np.arange(256, dtype=np.float32)
+    blended = np.float32(degenerate) + np.float32(factor)*(values - np.float32(degenerate))
+    return np.clip(blended, 0, 255).astype(np.uint8)
+
+
+def despeckleArray(img,threshold=True,smooth=True,enhance=True):
+    """
+    De-speckle a tile image array, giving the same result as despeckleImage in a single pass over the image.
+
+    The 3x3 SMOOTH kernel sum (center weight 5, the others 1) is found with integer arithmetic (PIL leaves 
+    the edge pixels unchanged), and since every step after it maps pixel values to pixel values the rounding 
+    of the smoothing, the brightness and contrast enhancement (blends computed as PIL does), and the threshold 
+    are applied together as one lookup table indexed by the kernel sum. The contrast enhancement depends on 
+    the mean (luminance) of the brightened image, which is also found by lookups of the kernel sums.
+
+    Parameters
+    ----------
+    img: array
+      The tile image (uint8, greyscale or RGB).
+    threshold, smooth, enhance: boolean (default True)
+      As for despeckleImage.
+
+    Returns
+    -------
+    The de-speckled image (uint8 array).
+    """
+
+    img = np.asarray(img)
+    if smooth == True:
+        # kernel sums, 13 times the value at the (unchanged) edges
+        sums = img.astype(np.uint16)*13
+        center = sums[1:-1,1:-1]
+        np.multiply(img[1:-1,1:-1], 5, out=center, dtype=np.uint16)
+        for rows, cols in product((slice(None,-2), slice(1,-1), slice(2,None)), repeat=2):
+            if (rows, cols) != (slice(1,-1), slice(1,-1)):
+                center += img[rows,cols]
+        table = (2*np.arange(13*255 + 1) + 13)//26
+    else:
+        sums = img
+        table = np.arange(256)
+
+    if enhance == True:
+        table = _blendTable(0, enhancement)[table]
+
+        # the mean (rounded) of the brightened image, in greyscale (as PIL converts RGB to L), for the contrast
+        if img.ndim == 2:
+            grey = np.take(table.astype(np.uint8), sums)
+        else:
+            grey = np.full(sums.shape[:2], 0x8000, dtype=np.int32)
+            for band, weight in enumerate((19595, 38470, 7471)):
+                grey += np.take(table.astype(np.int32)*weight, sums[...,band])
+            grey >>= 16
+        mean = int(grey.sum(dtype=np.int64) / grey.size + 0.5)
+        table = _blendTable(mean, enhancement)[table]
 
+    if threshold == True:
+        table = np.where(table > thresh, table, 0)
 
-def despeckle(depth,inDir,outDir,txrange,tyrange,
-              threshold=True,smooth=True,enhance=True,restart=False):
+    return np.take(table.astype(np.uint8), sums)
 
-    for tx,ty in product(range(*txrange),range(*tyrange)):
-        pth = '/' + str(depth) + '/' + str(ty) + '/' + str(ty) + '_' + str(tx) + '.png'
 
-        # checking if the despeckled file already exists
-        if os.path.isfile(outDir+pth) and restart:
-            continue
-
-        # making sure the file to de-speckle exists
-        if not os.path.isfile(inDir+pth): 
-            continue
+def despeckle(depth,inDir,outDir,txrange,tyrange,
+              threshold=True,smooth=True,enhance=True,restart=False,engine='pil'):
+    """
+    De-speckle the tiles of a TOAST layer (see despeckleImage).
+
+    Parameters
+    ----------
+    depth: int
+      TOAST layer to be de-speckled
+    inDir/outDir: string
+      Directories of the original and de-speckled tiles (may be the same).
+    txrange/tyrange: array
+      x and y ranges of tiles to de-speckle in the form [min,max] (the tiles that exist are found by scanning
+      the layer's directories, see psTiles.existingTiles)
+    threshold, smooth, enhance: boolean (default True)
+      As for despeckleImage.
+    restart: boolean (default False)
+      If True, tiles which already exist in outDir are not re-made.
+    engine: string (default 'pil')
+      'pil' (despeckleImage) or 'numpy' (despeckleArray, giving the same tiles).
+    """
+
+    tiles = psTiles.existingTiles(inDir,depth,txrange,tyrange)
+
+    # skipping the already despeckled files
+    if restart:
+        tiles -= psTiles.existingTiles(outDir,depth,txrange,tyrange)
+
+    madeDirs = set()
+    for tx,ty in sorted(tiles, key=lambda tile: tile[::-1]):
+        pth = '/' + str(depth) + '/' + str(ty) + '/' + str(ty) + '_' + str(tx) + '.png'
 
         try:
             origImg = Image.open(inDir + pth)
         except:
             print("Problem with " + inDir + pth)
             continue
-            
-        if smooth == True:
-            cleanImg = origImg.filter(ImageFilter.SMOOTH)
-        else:
-            cleanImg = origImg 
-
 
-        if enhance == True:
-            brightness = ImageEnhance.Brightness(cleanImg)
-            cleanImg = brightness.enhance(1.1)
-        
-            contrast = ImageEnhance.Contrast(cleanImg)
-	    cleanImg = contrast.enhance(1.1)
-
-        if threshold == True:
-            try:
-                retval, cleanImg = cv2.threshold(np.array(cleanImg), thresh, 255, cv2.THRESH_TOZERO)
-                cleanImg = Image.fromarray(cleanImg)
-            except:
-                print("Problem thresholding " + inDir + pth)
+        try:
+            if engine == 'numpy':
+                cleanImg = Image.fromarray(despeckleArray(np.asarray(origImg),threshold,smooth,enhance))
+            else:
+                cleanImg = despeckleImage(origImg,threshold,smooth,enhance)
+        except:
+            print("Problem de-speckling " + inDir + pth)
+            continue
 
         direc, _ = os.path.split(outDir+pth)
-        if not os.path.exists(direc):
-            os.makedirs(direc)
+        if direc not in madeDirs:
+            os.makedirs(direc, exist_ok=True)
+            madeDirs.add(direc)
 
         try:
             cleanImg.save(outDir+pth)
@@ -67,13 +184,13 @@ def despeckle(depth,inDir,outDir,txrange,tyrange,
 
 
 def usage():
-    print("psSmoothing.py -i <input directory> -o <output directory> -d <depth> [-x <tile x range> -y <tile y range> -t -s -e -r]")
+    print("psSmoothing.py -i <input directory> -o <output directory> -d <depth> [-x <tile x range> -y <tile y range> -t -s -e -r -n <engine>]")
 
     
 if __name__ == "__main__":
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:],"hi:o:d:x:y:tser",["help","inDir=","outDir","depth=","txrange=","tyrange=","threshold","smooth","enhance","restart"])
+        opts, args = getopt.getopt(sys.argv[1:],"hi:o:d:x:y:tsern:",["help","inDir=","outDir","depth=","txrange=","tyrange=","threshold","smooth","enhance","restart","engine="])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -88,6 +205,7 @@ if __name__ == "__main__":
     smooth = False
     enhance = False
     restart = False
+    engine = 'pil'
 
     for opt, arg in opts:
         if opt in ('-h','--help'):
@@ -129,6 +247,11 @@ if __name__ == "__main__":
             enhance = True
         if opt in ('-r','--restart'):
             restart = True
+        if opt in ('-n','--engine'):
+            engine = arg
+            if engine not in engines:
+                print("Engine must be one of: " + ", ".join(engines))
+                sys.exit(2)
 
     if not (inDir):
         print("Directory containing images to be de-speckled must be supplied.")
@@ -148,16 +271,16 @@ if __name__ == "__main__":
         
     maxTileDim = 2**depth
     if not txRange:
-        txRange = maxTileDim
+        txRange = [0,maxTileDim]
     if not tyRange:
-        tyRange = maxTileDim
+        tyRange = [0,maxTileDim]
 
-    if (depth > 8) and  (txRange == maxTileDim) and (tyRange == maxTileDim):
+    if (depth > 8) and  (txRange == [0,maxTileDim]) and (tyRange == [0,maxTileDim]):
         print("You have requested de-speckling of all tiles at depth %d." % depth)
         print("This may take a while, please be patient, or start with a smaller section.")
 
     start = time.time()
-    despeckle(depth,inDir,outDir,txRange,tyRange,threshold,smooth,enhance,restart)
+    despeckle(depth,inDir,outDir,txRange,tyRange,threshold,smooth,enhance,restart,engine)
     end = time.time()
     print(end-start)
 
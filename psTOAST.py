@@ -4,73 +4,653 @@ import sys, getopt
 
 import numpy as np
 
-from astropy.io import fits, asciiq
+from astropy.io import fits
+from astropy.io.fits.verify import VerifyError
 
 from toasty import toast
-from toasty.norm import normalize
 import ps1skycell_toast as pssc
+from psCatalog import readCatalog
+from psNormalize import normalizeSkycell, skycellLimits, statsCatalog, engines as normEngines
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from itertools import zip_longest, islice
+import os
 import time
+import json
+import hashlib
+import tempfile
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
-Data = namedtuple('Data','img cnt')
+import psTiles
+
+Data = namedtuple('Data','img nbytes')
 
 # Can't figure out a better way to deal with the problems getting array values gt or lt a scaler while ignoring the np.nans
 import warnings
 warnings.filterwarnings("ignore",category=RuntimeWarning,message="invalid value encountered in greater_equal")
 warnings.filterwarnings("ignore",category=RuntimeWarning,message="invalid value encountered in less_equal")
 
+class skycellStore:
+    """On disk store of normalized skycell images, kept as .npy files that are read back memory-mapped."""
+    def __init__(self,storeDir):
+        """Sets up the store in the directory storeDir (created if needed)."""
+        self.storeDir = storeDir
+        os.makedirs(storeDir,exist_ok=True)
+
+    def paths(self,filename):
+        """Returns the image and metadata file paths used to store the file 'filename'."""
+        key = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+        base = os.path.join(self.storeDir,key[:2],key)
+        return base + '.npy', base + '.json'
+
+    def meta(self,filename,settings):
+        """Returns the metadata that identifies the current version of the file 'filename' 
+        normalized with the given settings (see fitsCache.settings)."""
+        st = os.stat(filename)
+        return dict(settings, file=os.path.abspath(filename), size=st.st_size, mtime=st.st_mtime_ns)
+
+    def load(self,filename,settings):
+        """Returns the stored image for the file 'filename' memory-mapped read only, or None if it is 
+        not stored, the file has changed since it was stored, or it was stored with other settings."""
+        npyFile, metaFile = self.paths(filename)
+        try:
+            with open(metaFile) as fle:
+                if json.load(fle) != self.meta(filename,settings):
+                    return None
+            return np.load(npyFile,mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+    def save(self,filename,settings,imgData):
+        """Stores the normalized image imgData for the file 'filename'.
+
+        Returns the stored image memory-mapped (so the pages are shared with any other process using the store), 
+        or imgData itself if it could not be saved."""
+        npyFile, metaFile = self.paths(filename)
+        tmpExt = '.%d.tmp' % os.getpid()
+        try:
+            os.makedirs(os.path.dirname(npyFile),exist_ok=True)
+            # writing to temporary files and renaming so other processes never see partial files
+            with open(npyFile + tmpExt,'wb') as fle:
+                np.save(fle,imgData)
+            os.replace(npyFile + tmpExt,npyFile)
+            with open(metaFile + tmpExt,'w') as fle:
+                json.dump(self.meta(filename,settings),fle)
+            os.replace(metaFile + tmpExt,metaFile)
+            return np.load(npyFile,mmap_mode='r')
+        except OSError:
+            print("Problem storing " + filename)
+            return imgData
+
+
+class geometryStore:
+    """On disk store of per-tile skycell lookups (the projcell, subcell, x, y of each tile pixel).
+
+    The lookups depend only on the TOAST pixel grid, not the band, so one store can be shared by the runs for each band.
+    They are kept as compressed .npz files with compact types (int16 projcell, x, y and uint8 subcell)."""
+
+    # pixel positions beyond the int16 range are stored as -1 (they are off the skycell image either way)
+    xyRange = (np.iinfo(np.int16).min,np.iinfo(np.int16).max)
+    
+    def __init__(self,storeDir,geometryDtype='float64',geometryTolerance=0):
+        """Sets up the store in the directory storeDir (created if needed), for lookups computed with geometryDtype
+        (and interpolated with geometryTolerance, see ps1skycell_toast.findskycell_interp)."""
+        self.storeDir = storeDir
+        self.geometryDtype = geometryDtype
+        self.geometryTolerance = geometryTolerance
+        os.makedirs(storeDir,exist_ok=True)
+
+    def key(self,raArr,decArr):
+        """Returns the key of the tile with pixel positions (raArr, decArr), a digest of the positions."""
+        digest = hashlib.sha1(str(np.shape(raArr)).encode())
+        digest.update(np.ascontiguousarray(raArr,dtype=np.float64))
+        digest.update(np.ascontiguousarray(decArr,dtype=np.float64))
+        key = digest.hexdigest()
+        return os.path.join(key[:2],key)
+
+    @staticmethod
+    def tileKey(n,x,y):
+        """Returns the key of TOAST tile (n, x, y), for callers that know the tile being sampled."""
+        return os.path.join(str(n),str(y),'%d_%d' % (y,x))
+
+    def path(self,key):
+        """Returns the file path used to store the lookup with key 'key'."""
+        return os.path.join(self.storeDir,key + '.npz')
+
+    def load(self,key):
+        """Returns the stored lookup for key 'key' as a dictionary of projcell, subcell, x, y arrays,
+        or None if it is not stored (or was stored with another geometryDtype or geometryTolerance)."""
+        try:
+            with np.load(self.path(key)) as npz:
+                if str(npz['geometryDtype']) != self.geometryDtype:
+                    return None
+                if float(npz['geometryTolerance']) != self.geometryTolerance:
+                    return None
+                return {col: npz[col] for col in ('projcell','subcell','x','y')}
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self,key,pixelInfo):
+        """Stores the lookup pixelInfo (a dictionary with projcell, subcell, x, y arrays) with key 'key'."""
+        npzFile = self.path(key)
+        tmpFile = npzFile + '.%d.tmp' % os.getpid()
+        xy = {col: np.where((pixelInfo[col] < self.xyRange[0]) | (pixelInfo[col] > self.xyRange[1]),
+                            -1,pixelInfo[col]).astype(np.int16) for col in ('x','y')}
+        try:
+            os.makedirs(os.path.dirname(npzFile),exist_ok=True)
+            # writing to a temporary file and renaming so other processes never see partial files
+            with open(tmpFile,'wb') as fle:
+                np.savez_compressed(fle,projcell=pixelInfo['projcell'].astype(np.int16),
+                                    subcell=pixelInfo['subcell'].astype(np.uint8),
+                                    geometryDtype=self.geometryDtype,geometryTolerance=self.geometryTolerance,**xy)
+            os.replace(tmpFile,npzFile)
+        except OSError:
+            print("Problem storing geometry " + key)
+
+
+# the types normalized skycell images can be cached as (the normalized values are 0-255)
+cacheDtypes = ('uint8','uint16','float16','float32','float64')
+
+
 class fitsCache:
-    """"Caching fitsfile image data"""
-    def __init__(self,maxItems):
-        """Sets up the cache, with maximum number of items set to maxItems"""
-        self.cache = {}
-        self.count = 0
-        self.maxItms = maxItems
+    """"Caching fitsfile image data, least recently used images are evicted first.
+
+    The cache is thread safe, and can load images in background threads ahead of their use (see prefetch).
+    If it is given the files the coming steps (tiles) will use (see setSchedule), the image whose next use 
+    is furthest away is evicted instead."""
+    def __init__(self,maxBytes,dtype=None,store=None,normEngine='toasty',subsample=1,stats=None,prefetchThreads=0):
+        """Sets up the cache, with the total size of the cached images limited to maxBytes.
+
+        If dtype is given normalized images are stored as that type (one of cacheDtypes), otherwise as float64.
+        Images are quantized by casting, the same way vec2Pix casts them into uint8 tiles, so storing
+        as uint8 gives identical tiles for an eighth of the memory.
+        If store (a skycellStore) is given, normalized images are read from/saved to it.
+        normEngine and subsample are passed to psNormalize.normalizeSkycell.
+        If stats (a psNormalize.statsCatalog) is given, normalization limits are taken from/saved to it.
+        prefetchThreads is the number of background threads used to prefetch images."""
+        self.cache = OrderedDict()
+        self.nbytes = 0
+        self.maxBytes = maxBytes
+        self.store = store
+        self.normEngine = normEngine
+        self.subsample = subsample
+        self.limitsCatalog = stats
+        self.lock = threading.RLock()
+        self.pending = {}
+        self.pool = None
+        self.prefetchThreads = 0
+        self.setPrefetch(prefetchThreads)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetched = 0
+        self.prefetchHits = 0
+        self.reads = 0
+        self.schedule = None
+        self.step = 0
+        self.setDtype(dtype)
         
     def remove(self,filename):
         """Removes the file 'filename' from the cache."""
-        if filename not in self.cache:
-            return
-        del(self.cache[filename])
+        with self.lock:
+            if filename not in self.cache:
+                return
+            self.nbytes -= self.cache.pop(filename).nbytes
     
     def oldest(self):
-        """Returns the oldest item in the cache."""
-        return sorted([(y.cnt,x) for x,y in self.cache.items()])[0][1]
+        """Returns the least recently used item in the cache."""
+        return next(iter(self.cache))
+
+    def nextUse(self,filename):
+        """Returns the next step (at or after the current one) at which the file 'filename' is scheduled 
+        to be used, infinity if it is not."""
+        uses = self.schedule.get(filename)
+        if uses is None:
+            return np.inf
+        idx = np.searchsorted(uses,self.step)
+        return uses[idx] if idx < len(uses) else np.inf
+
+    def victim(self):
+        """Returns the item to evict, the one used furthest in the future if there is a schedule
+        (least recently used first among those equally far), otherwise the least recently used."""
+        if self.schedule is None:
+            return self.oldest()
+        return max(self.cache,key=self.nextUse)
+
+    def evict(self,nbytes=0):
+        """Evicts items (see victim) until nbytes more will fit in the cache."""
+        with self.lock:
+            while self.cache and (self.nbytes + nbytes > self.maxBytes):
+                self.remove(self.victim())
+                self.evictions += 1
+
+    def setSchedule(self,stepFiles):
+        """Gives the cache the files each coming step will use (a list of lists of filenames, one per step, 
+        starting at step 0), so that evictions can take them into account (None drops the schedule)."""
+        with self.lock:
+            self.step = 0
+            if stepFiles is None:
+                self.schedule = None
+                return
+            uses = {}
+            for step, filenames in enumerate(stepFiles):
+                for filename in filenames:
+                    uses.setdefault(filename,[]).append(step)
+            self.schedule = {filename: np.array(steps) for filename, steps in uses.items()}
+
+    def advance(self,steps=1):
+        """Moves on steps steps in the schedule."""
+        with self.lock:
+            self.step += steps
+
+    def capacity(self):
+        """Returns the number of images the cache can hold, estimated from the images in it."""
+        with self.lock:
+            sizes = [data.nbytes for data in self.cache.values() if data.nbytes]
+        if not sizes:
+            return len(self.cache) + self.prefetchThreads
+        return int(self.maxBytes // (sum(sizes)/len(sizes)))
+
+    def clear(self):
+        """Empties the cache (images being prefetched are waited for first)."""
+        for fut in list(self.pending.values()):
+            fut.result()
+        with self.lock:
+            self.cache.clear()
+            self.nbytes = 0
+
+    def setDtype(self,dtype):
+        """Changes the type normalized images are stored as (one of cacheDtypes, or None for float64), 
+        emptying the cache."""
+        if (dtype is not None) and (np.dtype(dtype).name not in cacheDtypes):
+            raise ValueError("Cache dtype must be one of: " + ", ".join(cacheDtypes))
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.clear()
+
+    def settings(self):
+        """Returns a dictionary of the settings that determine the cached images."""
+        return {'dtype': None if self.dtype is None else self.dtype.name, 
+                'norm': self.normEngine, 'subsample': self.subsample}
+
+    def setNormalization(self,normEngine,subsample=1):
+        """Changes the normalization engine and percentile subsampling, emptying the cache."""
+        self.normEngine = normEngine
+        self.subsample = subsample
+        self.clear()
+
+    def setStats(self,stats):
+        """Changes the normalization limits catalog used by the cache."""
+        self.limitsCatalog = stats
+
+    def setStore(self,store):
+        """Changes the skycell store used by the cache."""
+        self.store = store
+
+    def setMaxBytes(self,maxBytes):
+        """Changes the size limit of the cache, evicting items as needed."""
+        self.maxBytes = maxBytes
+        self.evict()
+
+    def setPrefetch(self,prefetchThreads):
+        """Changes the number of background threads used to prefetch images (0 turns prefetching off)."""
+        if self.pool:
+            # not yet started prefetches are dropped
+            self.pool.shutdown(wait=True,cancel_futures=True)
+            with self.lock:
+                self.pending.clear()
+        self.pool = ThreadPoolExecutor(prefetchThreads) if prefetchThreads > 0 else None
+        self.prefetchThreads = prefetchThreads
     
-    def add(self,filename):
-        """Adds the file 'filename' to the cache.  
+    def read(self,filename):
+        """Reads the image in file 'filename'.
 
         Additionally normalizes the image with a sinh stretch, and min/max values that are the average of 0.5 percentile and -13/4.3"""
-        if len(self.cache) == self.maxItms:
-            self.remove(self.oldest())
-        try:
-            fitsfile = fits.open(filename)
-            imgData = fitsfile[1].data
-            fitsfile.close()
-            
-            # doing image processing here
-            imean = np.nanmean(imgData)
-            vmax = (np.percentile(imgData[imgData >= imean],99.5) + 4.3) / 2  # produces warning because of nans, deal with later
-            vmin = (np.percentile(imgData[imgData <= imean],0.5) - 1.3) / 2 #produces warning because of nans, deal with later
-            imgData[np.isnan(imgData)] = vmax
-            imgData = normalize(imgData,vmin,vmax,stretch='sinh')
+        fitsfile = fits.open(filename)
+        imgData = fitsfile[1].data
+        fitsfile.close()
+        with self.lock:
+            self.reads += 1
             
-            self.cache[filename] = Data(img=imgData,cnt=self.count)
-            
-        except: # Any problem with opening or reading results in a null image
-            self.cache[filename] = Data(img=None,cnt=self.count)
-        self.count += 1
+        # doing image processing here
+        limits = self.limitsCatalog.get(filename,self.subsample) if self.limitsCatalog else None
+        if not limits:
+            limits = skycellLimits(imgData,self.subsample)
+            if self.limitsCatalog:
+                self.limitsCatalog.put(filename,limits,self.subsample)
+        imgData = normalizeSkycell(imgData,self.normEngine,limits=limits)
+        if self.dtype is not None:
+            imgData = imgData.astype(self.dtype)
+        return imgData
+
+    def load(self,filename):
+        """Returns the image data for the file 'filename', from the skycell store if it is there and up to date, 
+        otherwise read from the file. A file that cannot be opened or read (I/O and FITS errors), or that has 
+        no valid pixels (skycellLimits raises ValueError), results in a null image (None), other errors are raised."""
+        try:
+            imgData = self.store.load(filename,self.settings()) if self.store else None
+            if imgData is None:
+                imgData = self.read(filename)
+                if self.store:
+                    imgData = self.store.save(filename,self.settings(),imgData)
+        except (OSError, IndexError, ValueError, VerifyError): # a missing, unreadable, or all nan file gives a null image
+            imgData = None
+        return imgData
+
+    def insert(self,filename,imgData):
+        """Puts the image data imgData for the file 'filename' into the cache, evicting items as needed."""
+        nbytes = 0 if imgData is None else imgData.nbytes
+        with self.lock:
+            self.remove(filename)
+            self.evict(nbytes)
+            self.cache[filename] = Data(img=imgData,nbytes=nbytes)
+            self.nbytes += nbytes
+    
+    def add(self,filename):
+        """Adds the file 'filename' to the cache."""
+        self.insert(filename,self.load(filename))
+
+    def prefetch(self,filenames):
+        """Starts loading the files in filenames that are not already cached in background threads.
+        Does nothing if prefetching is off."""
+        if not self.pool:
+            return
+        with self.lock:
+            for filename in filenames:
+                if (filename in self.cache) or (filename in self.pending):
+                    continue
+                self.pending[filename] = self.pool.submit(self.prefetchOne,filename)
+                self.prefetched += 1
+
+    def prefetchOne(self,filename):
+        """Loads the file 'filename' into the cache (run in a background thread)."""
+        try:
+            self.insert(filename,self.load(filename))
+        finally:
+            with self.lock:
+                self.pending.pop(filename,None)
 
     def get(self,filename):
         """Adds the file 'filename' to the cache, and returns its image data.'"""
-        if filename not in self.cache:
-            self.add(filename)
-        return self.cache[filename].img 
+        with self.lock:
+            if filename in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(filename)
+                return self.cache[filename].img
+            fut = self.pending.get(filename)
+            
+        if fut is not None:
+            # the file is being prefetched, waiting for it
+            fut.result()
+            with self.lock:
+                if filename in self.cache:
+                    self.prefetchHits += 1
+                    self.cache.move_to_end(filename)
+                    return self.cache[filename].img
+
+        with self.lock:
+            self.misses += 1
+        imgData = self.load(filename)
+        self.insert(filename,imgData)
+        return imgData
+
+    def stats(self):
+        """Returns a dictionary of cache hit/miss/eviction counts, the number of files read, and current size."""
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'prefetched': self.prefetched, 'prefetchHits': self.prefetchHits, 'reads': self.reads,
+                'items': len(self.cache), 'nbytes': self.nbytes, 'maxBytes': self.maxBytes}
+
+
+def parseBytes(size):
+    """Turns a size string such as '512M' or '4G' (or a plain number of bytes) into a number of bytes."""
+    size = str(size).strip().upper()
+    mult = 1
+    if size and size[-1] in 'KMGT':
+        mult = 1024**('KMGT'.index(size[-1]) + 1)
+        size = size[:-1]
+    return int(float(size) * mult)
+
+def defaultCacheSize():
+    """Returns the cache size set by the PSTOAST_CACHE_SIZE environment variable, or 2GB if it is not set 
+    (or cannot be read, so importing psTOAST never fails on it)."""
+    try:
+        return parseBytes(os.environ.get('PSTOAST_CACHE_SIZE','2G'))
+    except ValueError:
+        print("PSTOAST_CACHE_SIZE must be a number of bytes, optionally with a K/M/G/T suffix: 4G, using 2G")
+        return parseBytes('2G')
+
+# default cache size is 2GB per process, can be overridden by the PSTOAST_CACHE_SIZE environment variable
+# the PSTOAST_STORE environment variable sets a default skycell store directory,
+# and PSTOAST_STATS a default normalization limits catalog
+psCache = fitsCache(defaultCacheSize(),
+                    store=skycellStore(os.environ['PSTOAST_STORE']) if os.environ.get('PSTOAST_STORE') else None,
+                    stats=statsCatalog(os.environ['PSTOAST_STATS']) if os.environ.get('PSTOAST_STATS') else None)
+
+def neighbourhood(raArr,decArr,nSteps=13):
+    """
+    Predict the sky positions the tiles around the given one will sample.
+
+    The tile's corners are extended bilinearly (as unit vectors) to the 3x3 block of tiles around it,
+    which is sampled on an nSteps x nSteps grid. Tiles next to each other in the TOAST traversal are 
+    neighbours, so this covers the skycells the next tiles need.
+
+    Parameters
+    ----------
+    raArr, decArr: array
+      The (lon, lat) arrays of the tile, in radians.
+    nSteps: int (default 13)
+      Number of sample points along each side of the 3x3 block of tiles.
+
+    Returns
+    -------
+    (ra, dec) arrays in radians, ordered by distance from the tile.
+    """
+
+    corners = np.array([[raArr[0,0],raArr[0,-1]],[raArr[-1,0],raArr[-1,-1]]]), \
+              np.array([[decArr[0,0],decArr[0,-1]],[decArr[-1,0],decArr[-1,-1]]])
+    xyz = np.stack([np.cos(corners[1])*np.cos(corners[0]),np.cos(corners[1])*np.sin(corners[0]),np.sin(corners[1])])
+    
+    u = np.linspace(-1,2,nSteps)
+    v, u = np.meshgrid(u,u)
+    # nearest the tile first
+    order = np.argsort(np.maximum(abs(u - 0.5),abs(v - 0.5)).reshape(-1),kind='stable')
+    u, v = u.reshape(-1)[order], v.reshape(-1)[order]
+    pts = (xyz[:,0,0,None]*(1-u)*(1-v) + xyz[:,0,1,None]*(1-u)*v +
+           xyz[:,1,0,None]*u*(1-v) + xyz[:,1,1,None]*u*v)
     
-psCache = fitsCache(10)
+    ra = np.arctan2(pts[1],pts[0]) % (2*np.pi)
+    dec = np.arctan2(pts[2],np.hypot(pts[0],pts[1]))
+    return ra, dec
 
-def panstarrsSampler(filelocFile):
+
+def groupPixels(fileIdByPix):
+    """
+    Group pixels by the file they come from.
+
+    Parameters
+    ----------
+    fileIdByPix: int array
+      The file index of each pixel (-1 for pixels with no file).
+
+    Returns
+    -------
+    A list of (fileId, pixels) pairs, where pixels is an index array into the flattened fileIdByPix, 
+    for each distinct file index (including -1).
+    """
+
+    fileIdByPix = fileIdByPix.reshape(-1)
+    pixOrder = np.argsort(fileIdByPix, kind='stable')
+    sortedIds = fileIdByPix[pixOrder]
+    starts = np.flatnonzero(np.concatenate(([True], sortedIds[1:] != sortedIds[:-1])))
+    ends = np.append(starts[1:], len(sortedIds))
+    return [(sortedIds[s], pixOrder[s:e]) for s, e in zip(starts, ends)]
+
+
+def fillTile(groups, filePths, xPix, yPix, shape):
+    """
+    Fill a tile from the skycell images.
+
+    Parameters
+    ----------
+    groups: list
+      The tile pixels grouped by file, as returned by groupPixels.
+    filePths: list
+      The file paths the file indices refer to.
+    xPix, yPix: int array
+      The (flattened) skycell pixel position of each tile pixel.
+    shape: tuple
+      Shape of the tile.
+
+    Returns
+    -------
+    The tile (uint8 array).
+    """
+
+    tile = np.zeros(shape, dtype=np.uint8) # this should be filled with whatever we want to signal "no data" 
+                                           # I am currently using zero
+    tilePix = tile.reshape(-1)
+
+    for fileId, pix2Fill in groups:
+        if fileId < 0:
+            continue
+        
+        # getting the image data 
+        imgData = psCache.get(filePths[fileId])
+
+        # file did not have any associated image data, probably the file was not found on disc
+        if imgData is None:
+            continue
+            
+        # getting the pixels we want out of this file
+        ylen,xlen = imgData.shape
+        x = xPix[pix2Fill]
+        y = yPix[pix2Fill]
+        inImg = (x >= 0) & (x < xlen) & (y >= 0) & (y < ylen)
+        tilePix[pix2Fill[inImg]] = imgData[y[inImg],x[inImg]]
+
+    return tile
+
+
+def skycellLookup(raArr, decArr, geometryDtype='float64', geometryTolerance=0):
+    """Returns the skycell lookup (projcell, subcell, x, y of each pixel) of the tile with pixel positions
+    (raArr, decArr), interpolated if geometryTolerance is not 0 (see ps1skycell_toast.findskycell_interp)."""
+    if geometryTolerance:
+        return pssc.findskycell_interp(raArr, decArr, geometryTolerance, geometryDtype)
+    return pssc.findskycell_pixels(raArr, decArr, geometryDtype)
+
+
+def panstarrsBandSampler(filelocFiles, geometryDtype='float64', geometryDir=None, geometryTolerance=0):
+    """
+    Build a sampler for panstarr images in several bands at once.
+
+    The skycell lookup of each tile is computed once and used to sample every band.
+
+    Parameters
+    ----------
+    filelocFiles: list
+      Files that contain the panstarrs images file locations organized by skycell, one per band.
+      File format is fixed-width table with columns 'SCn,' 'SCm,' and 'fileNPath,'
+      or a catalog compiled from one by psCatalog.py (.npz), which loads much faster.
+    geometryDtype: string (default 'float64')
+      Precision of the ra/dec to skycell pixel calculation (see ps1skycell_toast.findskycell_pixels),
+      'float32' is faster, but a small fraction of pixels may be sampled one pixel over.
+    geometryDir: string (default None)
+      Directory of a geometryStore, the skycell lookup of each tile is taken from it if there,
+      and otherwise computed and saved to it.
+    geometryTolerance: float (default 0)
+      If not 0, the skycell pixel positions of tiles in a single skycell are interpolated from a coarse grid
+      when that is accurate to geometryTolerance pixels (see ps1skycell_toast.findskycell_interp).
+
+    Returns
+    -------
+    A function which samples the panstarrs dataset, given arrays of (lon, lat) (and optionally the tile's 
+    geometryStore key), returning a list of the tile in each band (None for bands with no data in the tile).
+    Its batch attribute is the same for a stack of tiles (arrays of shape (number of tiles, ...), and optionally a list
+    of keys), the lookups, grouping by file, and reading of each file being done once for the whole stack. 
+    It returns for each band the list of tiles (views of one stack, None for tiles with no data in the band).
+    Its skycellFiles attribute is a function giving the files (of every band) of the skycells in a lookup.
+    """
+
+    catalogs = [readCatalog(filelocFile) for filelocFile in filelocFiles]
+    geometry = geometryStore(geometryDir,geometryDtype,geometryTolerance) if geometryDir else None
+    columns = ('projcell','subcell','x','y')
+
+    def lookupStack(raStack,decStack,keys):
+        # Getting info about skycell and pixel location for each tile's ra/decs, 
+        # from the store where possible, and otherwise for all the other tiles at once
+        lookups = [geometry.load(key) if geometry else None for key in keys]
+        todo = [i for i, lookup in enumerate(lookups) if lookup is None]
+        if todo and geometryTolerance:
+            for i in todo:
+                lookups[i] = skycellLookup(raStack[i], decStack[i], geometryDtype, geometryTolerance)
+        elif todo:
+            computed = pssc.findskycell_batch(raStack[todo], decStack[todo], dtype=geometryDtype)
+            for j, i in enumerate(todo):
+                lookups[i] = {col: computed[col][j] for col in columns}
+        if geometry:
+            for i in todo:
+                geometry.save(keys[i],lookups[i])
+        return {col: np.stack([lookup[col] for lookup in lookups]) for col in columns}
+
+    def vec2PixBatch(raStack,decStack,keys=None):
+        raStack, decStack = np.asarray(raStack), np.asarray(decStack)
+        if geometry and not keys:
+            keys = [geometry.key(raArr,decArr) for raArr, decArr in zip(raStack,decStack)]
+        pixelInfoArray = lookupStack(raStack, decStack, keys or [None]*len(raStack))
+
+        # Grouping the pixels of all the tiles by file in each band (None for bands with no files in any tile),
+        # and noting which tiles have files in each band
+        bandGroups, bandHasData = [], []
+        for psSC2FileId, filePths in catalogs:
+            fileIdByPix = psSC2FileId[pixelInfoArray['projcell'],pixelInfoArray['subcell']]
+            hasData = (fileIdByPix >= 0).reshape(len(raStack),-1).any(axis=1)
+            bandGroups.append(groupPixels(fileIdByPix) if hasData.any() else None)
+            bandHasData.append(hasData)
+
+        if psCache.pool and any(bandGroups):
+            # loading these tiles' files in parallel, then the files the tiles around the last one will need
+            raNear, decNear = neighbourhood(raStack[-1], decStack[-1])
+            nearInfo = pssc.findskycell_pixels(raNear, decNear, geometryDtype)
+            tileFiles, nearFiles = [], []
+            for groups, (psSC2FileId, filePths) in zip(bandGroups, catalogs):
+                tileIds = [fileId for fileId, _ in groups or [] if fileId >= 0]
+                nearIds = psSC2FileId[nearInfo['projcell'],nearInfo['subcell']]
+                _, first = np.unique(nearIds, return_index=True)
+                tileFiles += [filePths[fileId] for fileId in tileIds]
+                nearFiles.append([filePths[fileId] for fileId in nearIds[np.sort(first)] 
+                                  if (fileId >= 0) and (fileId not in tileIds)])
+            # nearest first, alternating between bands, and not prefetching more than fits in the cache 
+            # alongside these tiles' files
+            nearFiles = [fle for files in zip_longest(*nearFiles) for fle in files if fle]
+            psCache.prefetch(tileFiles + nearFiles[:max(psCache.capacity() - len(tileFiles), 0)])
+
+        xPix = pixelInfoArray['x'].reshape(-1)
+        yPix = pixelInfoArray['y'].reshape(-1)
+        tiles = []
+        for groups, hasData, (_, filePths) in zip(bandGroups, bandHasData, catalogs):
+            stack = None if groups is None else fillTile(groups, filePths, xPix, yPix, raStack.shape)
+            tiles.append([stack[i] if hasData[i] else None for i in range(len(raStack))])
+        return tiles
+
+    def vec2Pix(raArr,decArr,key=None):
+        return [bandTiles[0] for bandTiles in vec2PixBatch(np.asarray(raArr)[None], np.asarray(decArr)[None], 
+                                                            [key] if key else None)]
+
+    def skycellFiles(pixelInfoArray):
+        """Returns the files (of every band) of the skycells in the lookup pixelInfoArray."""
+        cells = np.unique(pixelInfoArray['projcell'].astype(np.int64)*100 + pixelInfoArray['subcell'])
+        return [filePths[fileId] for psSC2FileId, filePths in catalogs 
+                for fileId in psSC2FileId[cells//100, cells%100] if fileId >= 0]
+
+    # for sampling tiles in batches (see toastBands), and planning the order they are sampled in (see planTiles)
+    vec2Pix.batch = vec2PixBatch
+    vec2Pix.skycellFiles = skycellFiles
+    return vec2Pix
+
+
+def panstarrsSampler(filelocFile, geometryDtype='float64', geometryDir=None, geometryTolerance=0):
     """
     Build a sampler for panstarr images
 
@@ -78,85 +658,330 @@ def panstarrsSampler(filelocFile):
     ----------
     filelocFile: string
       File that contains the panstarrs images file locations organized by skycell. 
-      File format is fixed-width table with columns 'SCn,' 'SCm,' and 'fileNPath.'
+      File format is fixed-width table with columns 'SCn,' 'SCm,' and 'fileNPath,'
+      or a catalog compiled from one by psCatalog.py (.npz), which loads much faster.
+    geometryDtype: string (default 'float64')
+      Precision of the ra/dec to skycell pixel calculation (see ps1skycell_toast.findskycell_pixels),
+      'float32' is faster, but a small fraction of pixels may be sampled one pixel over.
+    geometryDir: string (default None)
+      Directory of a geometryStore, the skycell lookup of each tile is taken from it if there,
+      and otherwise computed and saved to it.
+    geometryTolerance: float (default 0)
+      If not 0, the skycell pixel positions of tiles in a single skycell are interpolated from a coarse grid
+      when that is accurate to geometryTolerance pixels (see ps1skycell_toast.findskycell_interp).
 
     Returns
     -------
     A function which samples the panstarrs dataset, given arrays of (lon, lat).
     """
 
-    
-    psCells = ascii.read(filelocFile)
-    psSC2FileLoc = np.full((max(psCells['SCn']) + 1,max(psCells['SCm']) + 1),"",dtype='<U168')
-    psSC2FileLoc[psCells['SCn'],psCells['SCm']] = psCells['fileNPath']
+    bandSampler = panstarrsBandSampler([filelocFile], geometryDtype, geometryDir, geometryTolerance)
     
     def vec2Pix(raArr,decArr):
+        return bandSampler(raArr,decArr)[0]
 
-        global psCache
-        
-        # Getting info about skycell and pixel location for given ra/decs
-        pixelInfoArray = pssc.findskycell(raArr, decArr)
-        
-        # Getting the file paths and creating a unique list of them
-        fileLocByPix = psSC2FileLoc[pixelInfoArray['projcell'],pixelInfoArray['subcell']]
-
-        filePths = {}
-        for line in fileLocByPix:
-            for filename in line:
-                filePths[filename] = filename
-        filePths = list(filePths.keys())
-            
-        tile = np.zeros(raArr.shape, dtype=np.uint8) # this should be filled with whatever we want to signal "no data" 
-                                     # I am currently using zero
+    return vec2Pix
 
-        if (len(filePths) == 1) and (not filePths[0]):
-            return None
-            
-        for dataFle in filePths:
-            if dataFle == '':
-                continue
-            
-            # getting the image data 
-            imgData = psCache.get(dataFle)
 
-            # file did not have any associated image data, probably the file was not found on disc
-            if imgData is None:
+# orders toastBands can make the tiles in
+tileOrders = ('traversal','hilbert','projcell')
+
+
+def planTiles(baseTiles, tileOrder, skycellFiles, npix=8):
+    """
+    Order tiles for skycell locality, and predict the files each one will use.
+
+    Parameters
+    ----------
+    baseTiles: list
+      The tiles (psTiles.Tile) to be made, in traversal order.
+    tileOrder: string
+      'traversal' keeps the traversal (Z) order, 'hilbert' orders the tiles along a Hilbert curve
+      (consecutive tiles are always neighbours), 'projcell' groups the tiles by the projection cell of their center 
+      (in traversal order within each).
+    skycellFiles: function
+      Returns the files of the skycells in a lookup, as the skycellFiles attribute of a panstarrsBandSampler.
+    npix: int (default 8)
+      The files of each tile are predicted from an npix x npix grid of points on it.
+
+    Returns
+    -------
+    (tiles, files) the ordered tiles, and the list of the files predicted for each.
+    """
+
+    if tileOrder not in tileOrders:
+        raise ValueError("Tile order must be one of: " + ", ".join(tileOrders))
+
+    lookups = [pssc.findskycell_pixels(*psTiles.tileLonLat(baseTile, npix)) for baseTile in baseTiles]
+    if tileOrder == 'hilbert':
+        order = np.argsort(psTiles.hilbertIndex(baseTiles[0].pos.n, [t.pos.x for t in baseTiles], 
+                                                [t.pos.y for t in baseTiles]), kind='stable') if baseTiles else []
+    elif tileOrder == 'projcell':
+        order = np.argsort([lookup['projcell'][npix//2, npix//2] for lookup in lookups], kind='stable')
+    else:
+        order = range(len(baseTiles))
+    return [baseTiles[i] for i in order], [skycellFiles(lookups[i]) for i in order]
+
+
+def toastBands(sampler, depth, outputDirs, skyRegion=None, tile=None, restart=False, tileOrder=None, batchSize=1):
+    """
+    Create the base layer TOAST tiles of several bands in one traversal.
+
+    Parameters
+    ----------
+    sampler: function
+      A sampler built by panstarrsBandSampler, for the bands in the order of outputDirs.
+    depth: int
+      The layer of TOAST tiles to be created.
+    outputDirs: list
+      The directory in which the TOAST tiles of each band will be saved.
+    skyRegion: array (default None)
+      The region of the sky to be toasted in the form ([raMin,raMax],[decMin,decMax]) (degrees).
+    tile: array  (default None)
+      The TOAST tile to be toasted in the form [depth,x,y].
+    restart: bool (default False)
+      True signals a restart job, so tiles that already exist in every band are not recalculated.
+    tileOrder: string (default None)
+      If given, the tiles are listed first and made in this order (see planTiles), with the skycell cache 
+      evicting the images whose predicted next use is furthest away. Otherwise tiles are made as they are 
+      traversed, with the least recently used images evicted.
+    batchSize: int (default 1)
+      Number of tiles sampled together (see panstarrsBandSampler's batch), which shares the lookups, 
+      grouping by file, and file reads among them.
+
+    Returns
+    -------
+    The number of tiles sampled.
+    """
+
+    top = psTiles.getTile(*tile) if tile else None
+    baseTiles = (baseTile for baseTile in psTiles.regionTiles(top, depth, skyRegion)
+                 if not (restart and all(os.path.exists(psTiles.tilePath(outputDir, *baseTile.pos)) 
+                                         for outputDir in outputDirs)))
+    if tileOrder:
+        baseTiles, tileFiles = planTiles(list(baseTiles), tileOrder, sampler.skycellFiles)
+        psCache.setSchedule(tileFiles)
+
+    count = 0
+    baseTiles = iter(baseTiles)
+    try:
+        for batch in iter(lambda: list(islice(baseTiles, batchSize)), []):
+            lonLats = [psTiles.tileLonLat(baseTile) for baseTile in batch]
+            bandTiles = sampler.batch(np.stack([raArr for raArr, _ in lonLats]), np.stack([decArr for _, decArr in lonLats]),
+                                      [geometryStore.tileKey(*baseTile.pos) for baseTile in batch])
+            for tiles, outputDir in zip(bandTiles, outputDirs):
+                for img, baseTile in zip(tiles, batch):
+                    if img is not None:
+                        psTiles.saveTile(img, psTiles.tilePath(outputDir, *baseTile.pos))
+            count += len(batch)
+            if tileOrder:
+                psCache.advance(len(batch))
+    finally:
+        if tileOrder:
+            psCache.setSchedule(None)
+    return count
+
+
+# engines toast_panstarrs can toast with
+toastEngines = ('tile','skycell')
+
+
+def toastSkycells(filelocFiles, depth, outputDirs, skyRegion=None, tile=None, restart=False,
+                  geometryDtype='float64', geometryDir=None, geometryTolerance=0):
+    """
+    Create the base layer TOAST tiles of one or more bands skycell by skycell, so each skycell image is read once.
+
+    First the skycell lookup of every tile is found (and kept in a geometryStore, a temporary one if geometryDir 
+    is not given), which gives the skycells each tile uses. Then the skycells are visited in the order of the first 
+    tile (in traversal order) using them, each skycell's images are scattered into the tiles that use it, 
+    and tiles are saved (and dropped from memory) as soon as all their skycells are done.
+    A tile's lookup is loaded once, when its first skycell is scattered, and kept (grouped by skycell) until it is saved.
+    The tiles are the same as those made by toastBands with the same sampler settings.
+
+    Parameters
+    ----------
+    filelocFiles: list
+      Files that contain the panstarrs images file locations organized by skycell, one per band
+      (see panstarrsBandSampler).
+    depth: int
+      The layer of TOAST tiles to be created.
+    outputDirs: list
+      The directory in which the TOAST tiles of each band will be saved.
+    skyRegion: array (default None)
+      The region of the sky to be toasted in the form ([raMin,raMax],[decMin,decMax]) (degrees).
+    tile: array  (default None)
+      The TOAST tile to be toasted in the form [depth,x,y].
+    restart: bool (default False)
+      True signals a restart job, so tiles that already exist in every band are not recalculated.
+    geometryDtype, geometryDir, geometryTolerance:
+      As for panstarrsBandSampler.
+
+    Returns
+    -------
+    The number of tiles made.
+    """
+
+    catalogs = [readCatalog(filelocFile) for filelocFile in filelocFiles]
+    tmpDir = None if geometryDir else tempfile.TemporaryDirectory(prefix='psTOAST')
+    geometry = geometryStore(geometryDir or tmpDir.name, geometryDtype, geometryTolerance)
+
+    try:
+        # the skycells (projcell*100 + subcell) used by each tile
+        tilePos, pairTile, pairCell = [], [], []
+        top = psTiles.getTile(*tile) if tile else None
+        for baseTile in psTiles.regionTiles(top, depth, skyRegion):
+            n, x, y = baseTile.pos
+            if restart and all(os.path.exists(psTiles.tilePath(outputDir, n, x, y)) for outputDir in outputDirs):
                 continue
-                
-            # getting the pixels we want out of this file
-            pix2Fill = (fileLocByPix == dataFle)
-            
-            try:
-                ylen,xlen = imgData.shape
-                pix2Fill[pixelInfoArray['y'] > ylen - 1] = False
-                pix2Fill[pixelInfoArray['y'] < 0] = False
-                pix2Fill[pixelInfoArray['x'] > xlen - 1] = False
-                pix2Fill[pixelInfoArray['x'] < 0] = False
-                tile[pix2Fill] = imgData[pixelInfoArray['y'][pix2Fill],pixelInfoArray['x'][pix2Fill]]
-            except IndexError:
-                print("Index Error!")
-                print(dataFle)
-                
-            tile[np.isnan(tile)] = 10 # making nan values appear as white
+            key = geometryStore.tileKey(n, x, y)
+            pixelInfoArray = geometry.load(key)
+            if pixelInfoArray is None:
+                pixelInfoArray = skycellLookup(*psTiles.tileLonLat(baseTile), geometryDtype, geometryTolerance)
+                geometry.save(key, pixelInfoArray)
+            cells = np.unique(pixelInfoArray['projcell'].astype(np.int64)*100 + pixelInfoArray['subcell'])
+            # skycells with no file in any band contribute nothing
+            cells = cells[np.any([psSC2FileId[cells//100, cells%100] >= 0 for psSC2FileId, _ in catalogs], axis=0)]
+            if len(cells):
+                pairTile.append(np.full(len(cells), len(tilePos)))
+                pairCell.append(cells)
+                tilePos.append((n, x, y))
+        if not tilePos:
+            return 0
 
-        return tile
+        pairTile = np.concatenate(pairTile)
+        cells, pairCellIdx = np.unique(np.concatenate(pairCell), return_inverse=True)
+        cellTiles = dict(groupPixels(pairCellIdx))
+        firstTile = np.full(len(cells), len(tilePos))
+        np.minimum.at(firstTile, pairCellIdx, pairTile)
+        cellOrder = np.argsort(firstTile, kind='stable')
+        remaining = np.bincount(pairTile, minlength=len(tilePos))
+        cellFiles = [[filePths[psSC2FileId[cell//100, cell%100]] if psSC2FileId[cell//100, cell%100] >= 0 else None
+                      for psSC2FileId, filePths in catalogs] for cell in cells]
 
-    return vec2Pix
+        buffers = {}
+        # the pixels (and skycell x, y) of each skycell in the lookups of the tiles being filled
+        tileCellPix = {}
+        for i, cellIdx in enumerate(cellOrder):
+            if psCache.pool:
+                # the next skycells' images are loaded while this one is scattered
+                psCache.prefetch([fle for idx in cellOrder[i:i + psCache.capacity()] 
+                                  for fle in cellFiles[idx] if fle][:psCache.capacity()])
+            images = [psCache.get(fle) if fle else None for fle in cellFiles[cellIdx]]
 
+            for tileIdx in pairTile[cellTiles[cellIdx]]:
+                n, x, y = tilePos[tileIdx]
+                if tileIdx not in tileCellPix:
+                    pixelInfoArray = geometry.load(geometryStore.tileKey(n, x, y))
+                    xArr = pixelInfoArray['x'].reshape(-1)
+                    yArr = pixelInfoArray['y'].reshape(-1)
+                    tileCellPix[tileIdx] = (pixelInfoArray['x'].shape, 
+                                            {cell: (pix, xArr[pix], yArr[pix]) for cell, pix in 
+                                             groupPixels(pixelInfoArray['projcell'].astype(np.int64)*100 + pixelInfoArray['subcell'])})
+                shape, cellPix = tileCellPix[tileIdx]
+                pix, xPix, yPix = cellPix.pop(cells[cellIdx])
 
-def toast_panstarrs(inputFile, depth, outputDir, skyRegion=None, tile=None, restart=False):
+                tileBufs = buffers.setdefault(tileIdx, [None]*len(catalogs))
+                for band, (fle, imgData) in enumerate(zip(cellFiles[cellIdx], images)):
+                    if fle is None:
+                        continue
+                    if tileBufs[band] is None:
+                        # as in fillTile, pixels with no data are zero
+                        tileBufs[band] = np.zeros(shape, dtype=np.uint8)
+                    if imgData is None:
+                        continue
+                    ylen, xlen = imgData.shape
+                    inImg = (xPix >= 0) & (xPix < xlen) & (yPix >= 0) & (yPix < ylen)
+                    tileBufs[band].reshape(-1)[pix[inImg]] = imgData[yPix[inImg], xPix[inImg]]
+
+                remaining[tileIdx] -= 1
+                if remaining[tileIdx] == 0:
+                    del tileCellPix[tileIdx]
+                    for img, outputDir in zip(buffers.pop(tileIdx), outputDirs):
+                        if img is not None:
+                            psTiles.saveTile(img, psTiles.tilePath(outputDir, n, x, y))
+        return len(tilePos)
+    finally:
+        if tmpDir:
+            tmpDir.cleanup()
+
+
+def toastChunks(depth, skyRegion=None, tile=None, workers=1, chunkDepth=None):
+    """
+    Divide the tiles to be toasted into chunks (TOAST tiles at chunkDepth) to be shared among workers.
+
+    Chunks are TOAST tiles, so the tiles of a chunk are neighbours on the sky and use the same skycells,
+    and they are listed in traversal (Z) order, so consecutive chunks are also near each other.
+
+    Parameters
+    ----------
+    depth: int
+      The layer of TOAST tiles to be created.
+    skyRegion: array (default None)
+      The region of the sky to be toasted in the form ([raMin,raMax],[decMin,decMax]) (degrees),
+      only the chunks that overlap it are returned.
+    tile: array  (default None)
+      The TOAST tile to be toasted in the form [depth,x,y].
+    workers: int (default 1)
+      Number of workers, used to choose the chunk depth if not given.
+    chunkDepth: int (default None)
+      Depth of the chunks (at most depth), by default the shallowest depth giving at least 4 chunks per worker.
+
+    Returns
+    -------
+    List of chunks in the form [depth,x,y].
+    """
+
+    chunks = [psTiles.getTile(*tile)] if tile else psTiles.topTiles()
+    if skyRegion:
+        chunks = [chunk for chunk in chunks if psTiles.overlapsRegion(chunk, *skyRegion)]
+
+    # dividing the chunks until they are at chunkDepth, or (by default) there are at least 4 per worker
+    while chunks and (chunks[0].pos.n < depth) and \
+          ((chunks[0].pos.n < chunkDepth) if chunkDepth else (len(chunks) < 4*workers)):
+        chunks = [child for chunk in chunks for child in psTiles.children(chunk)
+                  if (not skyRegion) or psTiles.overlapsRegion(child, *skyRegion)]
+    return [list(chunk.pos) for chunk in chunks]
+
+
+def _initWorker(toastPart, prefetch):
+    """Sets up a toasting worker process (threads do not survive the fork, so the prefetch pool is started here)."""
+    global workerToast
+    workerToast = toastPart
+    if prefetch:
+        psCache.setPrefetch(prefetch)
+
+
+def _toastChunk(chunk):
+    """Toasts one chunk in a worker process, returning (chunk, seconds, error message or None, 
+    number of tiles, number of skycell files read)."""
+    start = time.time()
+    reads = psCache.reads
+    try:
+        tiles = workerToast(tile=chunk)
+        return chunk, time.time() - start, None, tiles, psCache.reads - reads
+    except Exception:
+        return chunk, time.time() - start, traceback.format_exc(), 0, psCache.reads - reads
+
+
+def toast_panstarrs(inputFile, depth, outputDir, skyRegion=None, tile=None, restart=False, cacheSize=None, cacheDtype=None, storeDir=None,
+                    normEngine=None, subsample=1, statsFile=None, prefetch=0, workers=1, chunkDepth=None,
+                    geometryDtype='float64', geometryDir=None, geometryTolerance=0, toastEngine='tile', tileOrder=None,
+                    batchSize=1):
     """ 
     Create a base layer of TOAST tile from the panstarrs dataset.
 
     Parameters
     ----------
-    inputFile: string
+    inputFile: string or list
       File that contains the panstarrs images file locations organized by skycell. 
-      File format is fixed-width table with columns 'SCn,' 'SCm,' and 'fileNPath.'
+      File format is fixed-width table with columns 'SCn,' 'SCm,' and 'fileNPath,'
+      or a catalog compiled from one by psCatalog.py (.npz), which loads much faster.
+      Given a list of files (one per band) the tiles of all the bands are made in one pass, each tile's skycell
+      lookup being computed once and used for every band (see toastBands).
     depth: int
       The layer of TOAST tiles to be created (4**depth tiles will be created).
-    outputDir: string
-      The directory in which the TOAST tiles will be saved.
+    outputDir: string or list
+      The directory in which the TOAST tiles will be saved (a list of one directory per band if inputFile is a list).
     skyRegion: array (default None)
       The region of the sky to be toasted in the form ([raMin,raMax],[decMin,decMax]) (degrees). 
       This option cannot be used with the tile option.
@@ -165,20 +990,145 @@ def toast_panstarrs(inputFile, depth, outputDir, skyRegion=None, tile=None, rest
       This option cannot be used with the skyRegion option.
     restart: bool (default False)
       True signals a restart job, so any tiles already existing in the outPut directory should not be recalculated.
+    cacheSize: int (default None)
+      Maximum size in bytes of the skycell image cache. 
+      If not given the PSTOAST_CACHE_SIZE environment variable is used (default 2GB).
+    cacheDtype: string (default None)
+      Type the normalized skycell images are stored as in the cache (e.g. 'uint8'), default float64.
+      One of cacheDtypes (uint8, uint16, float16, float32, float64), uint8 produces identical tiles using 
+      an eighth of the memory, float16 is smaller but not exact.
+    storeDir: string (default None)
+      Directory of a persistent store of normalized skycell images, that are memory-mapped on later runs 
+      (entries are recreated if the FITS file changes). If not given the PSTOAST_STORE environment variable is used.
+    normEngine: string (default None)
+      Skycell normalization engine, 'toasty' (the default) uses toasty's normalize, 'fused' applies the same stretch 
+      block by block with no full size temporaries.
+    subsample: int (default 1)
+      If greater than 1 the normalization limits are computed from every subsample-th pixel (faster, but approximate).
+    statsFile: string (default None)
+      Catalog (sqlite database) of skycell normalization limits, limits are reused from it and new ones saved to it
+      (see psNormalize.py). If not given the PSTOAST_STATS environment variable is used.
+    prefetch: int (default 0)
+      Number of background threads loading skycell images ahead of use, the files of each tile are loaded in 
+      parallel, and those of the tiles around it prefetched while it is sampled (0 loads files as they are needed).
+    workers: int (default 1)
+      Number of worker processes, if more than 1 the tiles are divided into chunks (see toastChunks) that are
+      toasted by a process pool, with progress and failed chunks reported as they finish. 
+      Each worker has its own skycell cache of cacheSize. With a skyRegion the chunks that overlap it are toasted whole.
+    chunkDepth: int (default None)
+      Depth of the TOAST tiles the work is divided into, by default the shallowest depth giving at least 4 chunks per worker.
+    geometryDtype: string (default 'float64')
+      Precision of the ra/dec to skycell pixel calculation, 'float32' is faster, but a small fraction of pixels 
+      (those within a thousandth of a pixel of a pixel edge) may be sampled one pixel over.
+    geometryDir: string (default None)
+      Directory of a persistent store of the skycell lookup (projcell, subcell, x, y) of each tile. The lookups do not
+      depend on the band, so runs for other bands sharing the directory reuse them instead of recomputing them 
+      (about 20KB per tile). If not given the PSTOAST_GEOMETRY environment variable is used.
+    geometryTolerance: float (default 0)
+      If not 0, the skycell pixel positions of tiles lying in a single skycell are interpolated from the exact positions
+      on a coarse grid, when checks against the exact positions show it is accurate to geometryTolerance pixels
+      (e.g. 0.1), otherwise the exact positions are computed. Pixels within geometryTolerance of a skycell pixel edge
+      may be sampled one pixel over.
+    toastEngine: string (default 'tile')
+      'tile' samples the skycells tile by tile, 'skycell' goes through the skycells instead, reading each one once
+      and scattering it into the tiles that use it (see toastSkycells), the tiles are the same. With workers, 
+      the skycells on the edges of chunks are read once per chunk.
+    tileOrder: string (default None)
+      With the tile engine, the order to make the tiles in, 'traversal', 'hilbert', or 'projcell' (see planTiles), 
+      the files each tile will use are predicted, and the skycell cache evicts the images next used furthest 
+      in the future rather than the least recently used. The tiles are listed first, so with large regions this 
+      is best used with workers (each chunk is ordered separately). By default the tiles are made in toasty's
+      traversal order (psTiles' for several bands) as they are traversed.
+    batchSize: int (default 1)
+      With the tile engine, the number of tiles sampled together, their skycell lookups, grouping by file, and 
+      file reads being done once for the batch (which saves per tile overheads). 
+    
+    The number of skycell files read per tile made is printed at the end (or for each chunk, with workers).
+
+    Returns
+    -------
+    List of the chunks that failed (empty if all succeeded, or workers is 1).
     """
+
+    if cacheSize:
+        psCache.setMaxBytes(cacheSize)
+    if cacheDtype:
+        psCache.setDtype(cacheDtype)
+    if storeDir:
+        psCache.setStore(skycellStore(storeDir))
+    if statsFile:
+        psCache.setStats(statsCatalog(statsFile))
+    if normEngine or (subsample > 1):
+        psCache.setNormalization(normEngine or psCache.normEngine,subsample)
     
-    sampler = panstarrsSampler(inputFile)
-    if skyRegion:
-        toast(sampler, depth, outputDir, base_level_only=True, ra_range=skyRegion[0],dec_range=skyRegion[1],restart=restart)
-    elif tile:
-        toast(sampler, depth, outputDir, base_level_only=True, toast_tile=tile, restart=restart)
+    if toastEngine not in toastEngines:
+        raise ValueError("Toast engine must be one of: " + ", ".join(toastEngines))
+    if tileOrder and (tileOrder not in tileOrders):
+        raise ValueError("Tile order must be one of: " + ", ".join(tileOrders))
+
+    geometryDir = geometryDir or os.environ.get('PSTOAST_GEOMETRY')
+    if toastEngine == 'skycell':
+        inputFiles = [inputFile] if isinstance(inputFile, str) else inputFile
+        outputDirs = [outputDir] if isinstance(outputDir, str) else outputDir
+        if len(inputFiles) != len(outputDirs):
+            raise ValueError("There must be one output directory for each input file")
+        def toastPart(skyRegion=None, tile=None):
+            return toastSkycells(inputFiles, depth, outputDirs, skyRegion, tile, restart, 
+                          geometryDtype, geometryDir, geometryTolerance)
+    elif isinstance(inputFile, str) and not tileOrder and (batchSize == 1):
+        bandSampler = panstarrsSampler(inputFile, geometryDtype, geometryDir, geometryTolerance)
+        tileCount = [0]
+        def sampler(raArr,decArr):
+            tileCount[0] += 1
+            return bandSampler(raArr,decArr)
+        def toastPart(skyRegion=None, tile=None):
+            tileCount[0] = 0
+            if skyRegion:
+                toast(sampler, depth, outputDir, base_level_only=True, ra_range=skyRegion[0],dec_range=skyRegion[1],restart=restart)
+            elif tile:
+                toast(sampler, depth, outputDir, base_level_only=True, toast_tile=tile, restart=restart)
+            else:
+                toast(sampler, depth, outputDir, base_level_only=True, restart=restart)
+            return tileCount[0]
     else:
-        toast(sampler, depth, outputDir, base_level_only=True, restart=restart)
-    return
+        inputFiles = [inputFile] if isinstance(inputFile, str) else inputFile
+        outputDirs = [outputDir] if isinstance(outputDir, str) else outputDir
+        if len(inputFiles) != len(outputDirs):
+            raise ValueError("There must be one output directory for each input file")
+        sampler = panstarrsBandSampler(inputFiles, geometryDtype, geometryDir, geometryTolerance)
+        def toastPart(skyRegion=None, tile=None):
+            return toastBands(sampler, depth, outputDirs, skyRegion, tile, restart, tileOrder, batchSize)
+
+    if workers > 1:
+        chunks = toastChunks(depth, skyRegion, tile, workers, chunkDepth)
+        print("Toasting %d chunks with %d workers" % (len(chunks), workers))
+        failed = []
+        # the workers are forked, so share the sampler and cache settings
+        with multiprocessing.get_context('fork').Pool(workers, initializer=_initWorker, initargs=(toastPart, prefetch)) as pool:
+            for done, (chunk, secs, error, tiles, reads) in enumerate(pool.imap_unordered(_toastChunk, chunks), 1):
+                if error:
+                    failed.append(chunk)
+                    print("Chunk %s failed:\n%s" % (','.join(map(str,chunk)), error))
+                else:
+                    print("Chunk %s done in %.1fs, %d tiles, %.2f skycell reads per tile (%d/%d)" % 
+                          (','.join(map(str,chunk)), secs, tiles, reads/max(tiles,1), done, len(chunks)))
+                sys.stdout.flush()
+        return failed
+    
+    if prefetch:
+        psCache.setPrefetch(prefetch)
+    reads = psCache.reads
+    try:
+        tiles = toastPart(skyRegion, tile)
+    finally:
+        if prefetch:
+            psCache.setPrefetch(0) # dropping prefetches for tiles that will not be made
+    print("%d tiles, %.2f skycell reads per tile" % (tiles, (psCache.reads - reads)/max(tiles,1)))
+    return []
 
 
 def usage():
-    print("toastPanstarrs.py -i <inputfile> -d <depth> -o <outputdirectory> [-l <rarange> -b <decrange>] [-t <tile>] [-r]")
+    print("toastPanstarrs.py -i <inputfile> -d <depth> -o <outputdirectory> [-l <rarange> -b <decrange>] [-t <tile>] [-r] [-m <cachesize>] [-q <cachedtype>] [-s <storedir>] [-n <normengine>] [-p <subsample>] [-c <statsfile>] [-f <prefetch>] [-w <workers>] [-k <chunkdepth>] [-g <geometrydtype>] [-e <geometrydir>] [-a <geometrytolerance>] [-u <toastengine>] [-z <tileorder>] [-j <batchsize>]")
     print("""
     Create a base layer of TOAST tile from the panstarrs dataset.
 
@@ -186,11 +1136,14 @@ def usage():
     ----------
     inputFile: string
       File that contains the panstarrs images file locations organized by skycell. 
-      File format is fixed-width table with columns 'SCn,' 'SCm,' and 'fileNPath.'
+      File format is fixed-width table with columns 'SCn,' 'SCm,' and 'fileNPath,'
+      or a catalog compiled from one by psCatalog.py (.npz), which loads much faster.
+      A comma separated list of files (one per band) makes the tiles of all the bands in one pass.
     depth: int
       The layer of TOAST tiles to be created (4**depth tiles will be created).
     outputDir: string
-      The directory in which the TOAST tiles will be saved.
+      The directory in which the TOAST tiles will be saved (a comma separated list, one per band, 
+      for several input files).
     skyRegion: array (default None)
       The region of the sky to be toasted in the form ([raMin,raMax],[decMin,decMax]) (degrees). 
       This option cannot be used with the tile option.
@@ -199,13 +1152,60 @@ def usage():
       This option cannot be used with the skyRegion option.
     restart: bool (default False)
       True signals a restart job, so any tiles already existing in the outPut directory should not be recalculated.
+    cacheSize: string (default None)
+      Maximum size of the skycell image cache, in bytes or with a K/M/G/T suffix (e.g. 4G). 
+      If not given the PSTOAST_CACHE_SIZE environment variable is used (default 2G).
+    cacheDtype: string (default None)
+      Type the normalized skycell images are stored as in the cache (e.g. uint8), default float64.
+      One of cacheDtypes (uint8, uint16, float16, float32, float64), uint8 produces identical tiles using 
+      an eighth of the memory, float16 is smaller but not exact.
+    storeDir: string (default None)
+      Directory of a persistent store of normalized skycell images, that are memory-mapped on later runs 
+      (entries are recreated if the FITS file changes). If not given the PSTOAST_STORE environment variable is used.
+    normEngine: string (default toasty)
+      Skycell normalization engine, toasty uses toasty's normalize, fused applies the same stretch 
+      block by block with no full size temporaries.
+    subsample: int (default 1)
+      If greater than 1 the normalization limits are computed from every subsample-th pixel (faster, but approximate).
+    statsFile: string (default None)
+      Catalog (sqlite database) of skycell normalization limits, limits are reused from it and new ones saved to it
+      (see psNormalize.py). If not given the PSTOAST_STATS environment variable is used.
+    prefetch: int (default 0)
+      Number of background threads loading skycell images ahead of use, the files of each tile are loaded in 
+      parallel, and those of the tiles around it prefetched while it is sampled (0 loads files as they are needed).
+    workers: int (default 1)
+      Number of worker processes, if more than 1 the tiles are divided into chunks that are toasted by a process pool, 
+      with progress and failed chunks reported as they finish. Each worker has its own skycell cache of cachesize.
+      With a sky region the chunks that overlap it are toasted whole.
+    chunkDepth: int (default None)
+      Depth of the TOAST tiles the work is divided into, by default the shallowest depth giving at least 4 chunks per worker.
+    geometryDtype: string (default float64)
+      Precision of the ra/dec to skycell pixel calculation, float32 is faster, but a small fraction of pixels 
+      (those within a thousandth of a pixel of a pixel edge) may be sampled one pixel over.
+    geometryDir: string (default None)
+      Directory of a persistent store of the skycell lookup of each tile, which does not depend on the band, 
+      so runs for other bands sharing the directory reuse it. If not given the PSTOAST_GEOMETRY environment variable is used.
+    geometryTolerance: float (default 0)
+      If not 0, the skycell pixel positions of tiles lying in a single skycell are interpolated from a coarse grid
+      when that is accurate to geometrytolerance pixels (e.g. 0.1), pixels that close to a pixel edge may be sampled
+      one pixel over.
+    toastEngine: string (default tile)
+      tile samples the skycells tile by tile, skycell goes through the skycells instead, reading each one once
+      (once per chunk with workers) and scattering it into the tiles that use it, the tiles are the same.
+    tileOrder: string (default None)
+      With the tile engine, the order to make the tiles in (traversal, hilbert, or projcell), the files each tile 
+      will use are predicted, and the skycell cache evicts the images next used furthest in the future.
+      The tiles (of each chunk, with workers) are listed first.
+    batchSize: int (default 1)
+      With the tile engine, the number of tiles sampled together, sharing their skycell lookups, grouping by file, 
+      and file reads.
     """)
 
 
 if __name__ == "__main__":
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:],"hi:d:o:l:b:t:r",["help","inputfile","depth=","outdir=","rarange=","decrange=","tile=","restart"])
+        opts, args = getopt.getopt(sys.argv[1:],"hi:d:o:l:b:t:rm:q:s:n:p:c:f:w:k:g:e:a:u:z:j:",["help","inputfile","depth=","outdir=","rarange=","decrange=","tile=","restart","cachesize=","cachedtype=","store=","norm=","subsample=","stats=","prefetch=","workers=","chunkdepth=","geometry=","geometrydir=","geometrytolerance=","toastengine=","tileorder=","batchsize="])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -218,6 +1218,21 @@ if __name__ == "__main__":
     decRange = None
     toastTile = None
     restart = False
+    cacheSize = None
+    cacheDtype = None
+    storeDir = None
+    normEngine = None
+    subsample = 1
+    statsFile = None
+    prefetch = 0
+    workers = 1
+    chunkDepth = None
+    geometryDtype = 'float64'
+    geometryDir = None
+    geometryTolerance = 0
+    toastEngine = 'tile'
+    tileOrder = None
+    batchSize = 1
     
     for opt, arg in opts:
         if opt in ('-h','--help'):
@@ -262,12 +1277,93 @@ if __name__ == "__main__":
                 sys.exit(2)
         if opt in ('-r','--restart'):
             restart = True
+        if opt in ('-m','--cachesize'):
+            try:
+                cacheSize = parseBytes(arg)
+            except ValueError:
+                print("Cache size must be a number of bytes, optionally with a K/M/G/T suffix: 4G")
+                sys.exit(2)
+        if opt in ('-q','--cachedtype'):
+            if arg not in cacheDtypes:
+                print("Cache dtype must be one of: " + ", ".join(cacheDtypes))
+                sys.exit(2)
+            cacheDtype = arg
+        if opt in ('-s','--store'):
+            storeDir = arg
+        if opt in ('-n','--norm'):
+            if arg not in normEngines:
+                print("Normalization engine must be one of: " + ", ".join(normEngines))
+                sys.exit(2)
+            normEngine = arg
+        if opt in ('-p','--subsample'):
+            try:
+                subsample = int(arg)
+            except ValueError:
+                print("Subsample must be an integer")
+                sys.exit(2)
+        if opt in ('-c','--stats'):
+            statsFile = arg
+        if opt in ('-f','--prefetch'):
+            try:
+                prefetch = int(arg)
+            except ValueError:
+                print("Prefetch must be an integer number of threads")
+                sys.exit(2)
+        if opt in ('-w','--workers'):
+            try:
+                workers = int(arg)
+            except ValueError:
+                print("Workers must be an integer number of processes")
+                sys.exit(2)
+        if opt in ('-k','--chunkdepth'):
+            try:
+                chunkDepth = int(arg)
+            except ValueError:
+                print("Chunk depth must be an integer (base 10 please)")
+                sys.exit(2)
+        if opt in ('-g','--geometry'):
+            if arg not in ('float32','float64'):
+                print("Geometry dtype must be float32 or float64")
+                sys.exit(2)
+            geometryDtype = arg
+        if opt in ('-e','--geometrydir'):
+            geometryDir = arg
+        if opt in ('-a','--geometrytolerance'):
+            try:
+                geometryTolerance = float(arg)
+            except ValueError:
+                print("Geometry tolerance must be a number of pixels: 0.1")
+                sys.exit(2)
+        if opt in ('-u','--toastengine'):
+            if arg not in toastEngines:
+                print("Toast engine must be one of: " + ", ".join(toastEngines))
+                sys.exit(2)
+            toastEngine = arg
+        if opt in ('-z','--tileorder'):
+            if arg not in tileOrders:
+                print("Tile order must be one of: " + ", ".join(tileOrders))
+                sys.exit(2)
+            tileOrder = arg
+        if opt in ('-j','--batchsize'):
+            try:
+                batchSize = int(arg)
+            except ValueError:
+                print("Batch size must be an integer number of tiles")
+                sys.exit(2)
 
 
     if not (depth and outputDir and inputFile):
         print("Inputfile, depth, and outdir are required arguments.")
         usage()
         sys.exit(2)
+
+    # Several bands toasted together
+    if (',' in inputFile) or (',' in outputDir):
+        inputFile = inputFile.split(',')
+        outputDir = outputDir.split(',')
+        if len(inputFile) != len(outputDir):
+            print("There must be one output directory for each input file: g.npz,r.npz g/,r/")
+            sys.exit(2)
                 
     # The user has specified both ra/dec and tile options
     if (raRange or decRange) and toastTile:
@@ -286,15 +1382,24 @@ if __name__ == "__main__":
         print("         This is likely to take a very long time.")
 
                 
+    options = dict(restart=restart, cacheSize=cacheSize, cacheDtype=cacheDtype, storeDir=storeDir,
+                   normEngine=normEngine, subsample=subsample, statsFile=statsFile, prefetch=prefetch,
+                   workers=workers, chunkDepth=chunkDepth, geometryDtype=geometryDtype,
+                   geometryDir=geometryDir, geometryTolerance=geometryTolerance, toastEngine=toastEngine,
+                   tileOrder=tileOrder, batchSize=batchSize)
+                
     start = time.time()
     if (raRange and decRange):
-        toast_panstarrs(inputFile, depth, outputDir, skyRegion=(raRange,decRange),restart=restart)
+        failed = toast_panstarrs(inputFile, depth, outputDir, skyRegion=(raRange,decRange), **options)
     elif toastTile:
-        toast_panstarrs(inputFile, depth, outputDir, tile=toastTile,restart=restart)
+        failed = toast_panstarrs(inputFile, depth, outputDir, tile=toastTile, **options)
     else:
-        toast_panstarrs(inputFile, depth, outputDir,restart=restart)
+        failed = toast_panstarrs(inputFile, depth, outputDir, **options)
     end = time.time()
     print(end - start)
-
-
-           
+    if workers > 1:
+        if failed:
+            print("Failed chunks (rerun with -t and -r): " + " ".join(','.join(map(str,chunk)) for chunk in failed))
+            sys.exit(1)
+    else:
+        print("Cache hits: %(hits)d, misses: %(misses)d, evictions: %(evictions)d, files read: %(reads)d" % psCache.stats())
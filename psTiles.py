@@ -0,0 +1,248 @@
+"""TOAST tile geometry, following the tiling toasty uses.
+
+Tiles are identified by (n, x, y), n being the depth and x, y in 0..2**n-1, and are saved as n/y/y_x.png.
+The 4 depth 1 tiles cover the sky, and each tile is divided into 4 children at the midpoints of its edges
+(and the midpoint of one of its diagonals), corners are (lon, lat) in radians, ordered ul, ur, lr, ll.
+"""
+
+import numpy as np
+
+import os
+
+from collections import namedtuple
+
+Pos = namedtuple('Pos','n x y')
+Tile = namedtuple('Tile','pos corners increasing')
+
+level1 = [[np.radians(c) for c in row]
+          for row in [[(0, -90), (90, 0), (0, 90), (180, 0)],
+                      [(90, 0), (0, -90), (0, 0), (0, 90)],
+                      [(0, 90), (0, 0), (0, -90), (270, 0)],
+                      [(180, 0), (0, 90), (270, 0), (0, -90)]]]
+
+
+def lonlat2xyz(lon, lat):
+    """Returns the unit vector(s) of the given (lon, lat) in radians, stacked along the last axis."""
+    lon, lat = np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+    return np.stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def xyz2lonlat(xyz):
+    """Returns the (lon, lat) in radians (lon in 0..2pi) of the vector(s) xyz (along the last axis)."""
+    x, y, z = xyz[...,0], xyz[...,1], xyz[...,2]
+    return np.arctan2(y, x) % (2*np.pi), np.arctan2(z, np.hypot(x, y))
+
+
+def mid(a, b):
+    """Returns the midpoint on the sphere of the (lon, lat) points a and b."""
+    lon, lat = xyz2lonlat(lonlat2xyz(*a) + lonlat2xyz(*b))
+    return float(lon), float(lat)
+
+
+def topTiles():
+    """Returns the 4 depth 1 tiles, in traversal order."""
+    return [Tile(Pos(1, 0, 0), level1[0], True),
+            Tile(Pos(1, 1, 0), level1[1], False),
+            Tile(Pos(1, 1, 1), level1[2], True),
+            Tile(Pos(1, 0, 1), level1[3], False)]
+
+
+def children(tile):
+    """Returns the 4 children of tile, ordered (2x,2y), (2x+1,2y), (2x,2y+1), (2x+1,2y+1)."""
+    n, x, y = tile.pos
+    ul, ur, lr, ll = tile.corners
+    to = mid(ul, ur)
+    ri = mid(ur, lr)
+    bo = mid(lr, ll)
+    le = mid(ll, ul)
+    ce = mid(ll, ur) if tile.increasing else mid(ul, lr)
+    return [Tile(Pos(n + 1, 2*x, 2*y), (ul, to, ce, le), tile.increasing),
+            Tile(Pos(n + 1, 2*x + 1, 2*y), (to, ur, ri, ce), tile.increasing),
+            Tile(Pos(n + 1, 2*x, 2*y + 1), (le, ce, bo, ll), tile.increasing),
+            Tile(Pos(n + 1, 2*x + 1, 2*y + 1), (ce, ri, lr, bo), tile.increasing)]
+
+
+def getTile(n, x, y):
+    """Returns the tile (n, x, y) (n >= 1)."""
+    if n < 1:
+        raise ValueError("Tile depth must be at least 1")
+    tile = [t for t in topTiles() if t.pos == (1, x >> (n - 1), y >> (n - 1))][0]
+    for level in range(n - 2, -1, -1):
+        tile = children(tile)[((x >> level) & 1) + 2*((y >> level) & 1)]
+    return tile
+
+
+def subtiles(tile, depth):
+    """Yields the tiles at depth within tile (all the sky if tile is None), in traversal (Z) order."""
+    todo = topTiles() if tile is None else [tile]
+    for t in todo:
+        if t.pos.n >= depth:
+            yield t
+        else:
+            for child in children(t):
+                yield from subtiles(child, depth)
+
+
+def tilePath(baseDir, n, x, y):
+    """Returns the path of the tile (n, x, y) image under baseDir."""
+    return os.path.join(baseDir, str(n), str(y), '%d_%d.png' % (y, x))
+
+
+def existingTiles(baseDir, depth, txrange=None, tyrange=None):
+    """
+    Returns the set of (x, y) of the depth tiles saved under baseDir (as n/y/y_x.png) within the ranges
+    txrange and tyrange ([min,max], all tiles if None).
+
+    The tiles are found by scanning the layer's row directories once each, rather than checking each possible
+    tile, most of which do not exist for a survey covering part of the sky.
+    """
+
+    tiles = set()
+    try:
+        rows = list(os.scandir(os.path.join(baseDir, str(depth))))
+    except FileNotFoundError:
+        return tiles
+
+    for row in rows:
+        if not (row.name.isdigit() and row.is_dir()):
+            continue
+        y = int(row.name)
+        if tyrange and not (tyrange[0] <= y < tyrange[1]):
+            continue
+        prefix = row.name + '_'
+        with os.scandir(row.path) as entries:
+            for entry in entries:
+                x = entry.name[len(prefix):-len('.png')]
+                if entry.name.startswith(prefix) and entry.name.endswith('.png') and x.isdigit():
+                    if (not txrange) or (txrange[0] <= int(x) < txrange[1]):
+                        tiles.add((int(x), y))
+    return tiles
+
+
+def hilbertIndex(n, x, y):
+    """Returns the position of tile (n, x, y) along the Hilbert curve through the 2**n x 2**n tiles of depth n
+    (x and y may be arrays). Unlike the traversal (Z) order, consecutive tiles on the curve are always neighbours."""
+    x, y = np.array(x, dtype=np.int64), np.array(y, dtype=np.int64)
+    index = np.zeros_like(x)
+    size = 2**n
+    s = size//2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        index += s*s*((3*rx) ^ ry)
+        # rotating the quadrant
+        flip = ~ry & rx
+        x = np.where(flip, size - 1 - x, x)
+        y = np.where(flip, size - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s //= 2
+    return index
+
+
+def tileBounds(tile, levels=4):
+    """
+    Returns the (ra, dec) bounding box of tile, in degrees.
+
+    The box is found from the corners of the tile's descendants levels deeper, widened by the spacing between them.
+    If the tile touches a pole its ra range is the full circle, otherwise the ra range is the smallest arc covering
+    the tile, and may wrap (raMin > raMax).
+
+    Returns
+    -------
+    ([raMin, raMax], [decMin, decMax])
+    """
+
+    pts = [c for t in subtiles(tile, tile.pos.n + levels) for c in t.corners]
+    lon, lat = np.degrees(np.array(pts)).T
+    margin = np.degrees(np.pi/2) / 2**(tile.pos.n + levels - 1)
+
+    decRange = [max(lat.min() - margin, -90), min(lat.max() + margin, 90)]
+    if (decRange[0] == -90) or (decRange[1] == 90):
+        return [0, 360], decRange
+
+    # the smallest arc covering the ras is the complement of the largest gap between them
+    lon = np.sort(lon % 360)
+    gaps = np.diff(np.append(lon, lon[0] + 360))
+    widest = np.argmax(gaps)
+    raMargin = margin / np.cos(np.radians(max(abs(decRange[0]), abs(decRange[1]))))
+    if gaps[widest] <= 2*raMargin:
+        return [0, 360], decRange
+    return [(lon[(widest + 1) % len(lon)] - raMargin) % 360, (lon[widest] + raMargin) % 360], decRange
+
+
+def overlapsRegion(tile, raRange, decRange):
+    """Returns whether tile (may) overlap the region ([raMin, raMax], [decMin, decMax]) (degrees)."""
+
+    tileRa, tileDec = tileBounds(tile)
+    if (tileDec[1] < decRange[0]) or (tileDec[0] > decRange[1]):
+        return False
+    if (tileRa == [0, 360]) or (raRange[1] - raRange[0] >= 360):
+        return True
+
+    # comparing the arcs, both measured from the start of the region's ra range
+    regionLen = (raRange[1] - raRange[0]) % 360
+    start = (tileRa[0] - raRange[0]) % 360
+    tileLen = (tileRa[1] - tileRa[0]) % 360
+    return (start <= regionLen) or (start + tileLen >= 360)
+
+
+def regionTiles(tile, depth, skyRegion=None):
+    """Yields the tiles at depth within tile (all the sky if tile is None) that (may) overlap skyRegion
+    (all of them if skyRegion is None), in traversal order. Tiles are only divided if they overlap the region."""
+    todo = topTiles() if tile is None else [tile]
+    for t in todo:
+        if skyRegion and not overlapsRegion(t, *skyRegion):
+            continue
+        if t.pos.n >= depth:
+            yield t
+        else:
+            for child in children(t):
+                yield from regionTiles(child, depth, skyRegion)
+
+
+def tileLonLat(tile, npix=256):
+    """
+    Returns the (lon, lat) arrays (radians, npix x npix) of the pixel centers of tile.
+
+    The tile is divided by repeated midpoints (as tiles are divided into children) into a 2*npix+1 square grid, 
+    whose odd points are the pixel centers. Row 0 is the ul-ur edge.
+    """
+
+    size = 2*npix + 1
+    xyz = np.zeros((3, size, size))
+    ul, ur, lr, ll = [lonlat2xyz(*c) for c in tile.corners]
+    xyz[:, 0, 0], xyz[:, 0, -1], xyz[:, -1, -1], xyz[:, -1, 0] = ul, ur, lr, ll
+
+    # dividing all the cells of the grid at once, level by level
+    step = size - 1
+    while step > 1:
+        half = step//2
+        cellUl = xyz[:, 0:-1:step, 0:-1:step]
+        cellUr = xyz[:, 0:-1:step, step::step]
+        cellLr = xyz[:, step::step, step::step]
+        cellLl = xyz[:, step::step, 0:-1:step]
+        if half > 1: # the edge midpoints of the last level are not pixel centers
+            xyz[:, 0:-1:step, half::step] = _normed(cellUl + cellUr)
+            xyz[:, half::step, step::step] = _normed(cellUr + cellLr)
+            xyz[:, step::step, half::step] = _normed(cellLr + cellLl)
+            xyz[:, half::step, 0:-1:step] = _normed(cellLl + cellUl)
+        xyz[:, half::step, half::step] = _normed(cellLl + cellUr) if tile.increasing else _normed(cellUl + cellLr)
+        step = half
+
+    centers = xyz[:, 1::2, 1::2]
+    return np.arctan2(centers[1], centers[0]) % (2*np.pi), np.arctan2(centers[2], np.hypot(centers[0], centers[1]))
+
+
+def _normed(xyz):
+    """Returns the vectors xyz (along the first axis) scaled to unit length."""
+    return xyz / np.sqrt(xyz[0]**2 + xyz[1]**2 + xyz[2]**2)
+
+
+def saveTile(img, path):
+    """Saves the tile image img (uint8 array) as a PNG at path, creating directories as needed."""
+    from PIL import Image
+
+    direc, _ = os.path.split(path)
+    if not os.path.exists(direc):
+        os.makedirs(direc, exist_ok=True)
+    Image.fromarray(img).save(path)
@@ -1,17 +1,20 @@
 #!/bin/bash
 
-# Usage: runPSTOAST.sh inputfile toast/path
+# Usage: runPSTOAST.sh inputfile toast/path [geometry/path]
 
 # User must supply the file containing information about where to find
 # image files (basically determining which band is being toasted)
 # and the directory in which the toast tiles will be saved
 # these are $1 and $2 respectively
+# The tile skycell lookups are stored in $3 (default: geometry next to $2),
+# so the runs for the other bands reuse them
+GEOMETRY=${3:-$(dirname $2)/geometry}
 
-# This script divides the sky into 64 sections and toasts them
-for ((TX=0; TX < 8; TX++))
-do
-    for((TY=0; TY < 8; TY++))
-    do
-        nohup psTOAST.py -i $1 -d 12 -o $2 -t 3,${TX},${TY} -r &
-    done
-done 
+# The input file is compiled once into a binary catalog so each process starts quickly
+CATALOG=$2/catalog.npz
+mkdir -p $2
+psCatalog.py -i $1 -o $CATALOG
+
+# This script toasts the whole sky with 64 worker processes, 
+# which share out the sky in chunks (failed chunks are listed in $2/psTOAST.log)
+nohup psTOAST.py -i $CATALOG -d 12 -o $2 -r -q uint8 -c $2/normstats.db -e $GEOMETRY -w 64 > $2/psTOAST.log 2>&1 &
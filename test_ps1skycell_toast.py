@@ -0,0 +1,56 @@
+"""Tests of ps1skycell_toast's interpolated skycell lookup against the exact one."""
+
+import numpy as np
+import pytest
+
+import ps1skycell_toast as pssc
+import psTiles
+
+tolerance = 0.1
+
+# depth 12 tiles in a single skycell: mid latitude, high latitude, and at the north pole
+singleTiles = [(12, 2093, 1105), (12, 2062, 2484), (12, 2047, 2047)]
+# tiles spanning several skycells
+multiTiles = [(12, 3484, 2608), (12, 717, 3331)]
+# a tile at the south pole, below the coverage limit
+outsideTile = (12, 0, 0)
+
+
+def controlGrid(shape, step=32):
+    """The control rows and columns findskycell_interp uses (every step-th, plus the last)."""
+    return [np.unique(np.append(np.arange(0, size, step), size - 1)) for size in shape]
+
+
+@pytest.mark.parametrize('tile', singleTiles)
+def test_interpolation_within_tolerance(tile):
+    raArr, decArr = psTiles.tileLonLat(psTiles.getTile(*tile))
+    result = pssc.findskycell_interp(raArr, decArr, tolerance)
+    assert result['interpolated']
+
+    rows, cols = controlGrid(raArr.shape)
+    ctrl = np.ix_(rows, cols)
+    _, _, xgrid, ygrid = pssc._skycell_coords_block(raArr[ctrl].reshape(-1), decArr[ctrl].reshape(-1))
+    _, _, xpos, ypos = pssc._skycell_coords_block(raArr.reshape(-1), decArr.reshape(-1))
+    allRows, allCols = np.arange(raArr.shape[0]), np.arange(raArr.shape[1])
+    for grid, exact in ((xgrid, xpos), (ygrid, ypos)):
+        interp = pssc._bilinear(grid.reshape(len(rows), len(cols)), rows, cols, allRows, allCols)
+        assert np.abs(interp - exact.reshape(raArr.shape)).max() <= tolerance
+
+    exact = pssc.findskycell_pixels(raArr, decArr)
+    for col in ('projcell', 'subcell'):
+        assert np.array_equal(result[col], exact[col])
+    for col in ('x', 'y'):
+        assert np.abs(result[col] - exact[col]).max() <= 1
+
+
+@pytest.mark.parametrize('tile', multiTiles + [outsideTile])
+def test_other_tiles_are_exact(tile):
+    raArr, decArr = psTiles.tileLonLat(psTiles.getTile(*tile))
+    result = pssc.findskycell_interp(raArr, decArr, tolerance)
+    assert not result['interpolated']
+
+    exact = pssc.findskycell_pixels(raArr, decArr)
+    if tile in multiTiles:
+        assert len(np.unique(exact['projcell']*100 + exact['subcell'])) > 1
+    for col in ('projcell', 'subcell', 'x', 'y'):
+        assert np.array_equal(result[col], exact[col])
@@ -0,0 +1,29 @@
+"""Tests of psMerge's array merge engines against the PIL merges."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('toasty')
+
+import psMerge
+
+
+def mosaics(channels, n=2, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, (n, 512, 512) + ((channels,) if channels else ()), dtype=np.uint8)
+
+
+@pytest.mark.parametrize('channels', [0, 3])
+def test_numpy_engine_matches_pil(channels):
+    batch = mosaics(channels)
+    for arrayMerge, pilMerge in list(zip(psMerge.mergeEngines['numpy'], psMerge.mergeEngines['pil'])) + \
+                                [(psMerge.nearestMerges['numpy'], psMerge.nearestMerges['pil'])]:
+        merged = arrayMerge(batch)
+        for mosaic, tile in zip(batch, merged):
+            assert np.array_equal(arrayMerge(mosaic), pilMerge(mosaic))
+            assert np.array_equal(tile, pilMerge(mosaic))
+
+
+def test_alpha_mosaics_are_rejected():
+    with pytest.raises(ValueError):
+        psMerge.bicubicDownsample(mosaics(4)[0])
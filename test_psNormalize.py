@@ -0,0 +1,43 @@
+"""Tests of psNormalize's fused normalization engine against toasty's normalize."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('toasty')
+
+import psNormalize
+
+# the largest difference allowed between the stretched (0-255) values of the two engines
+tolerance = 1e-3
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float64'])
+def test_fused_matches_toasty(dtype, skycellImage):
+    imgData = skycellImage((1000, 1200)).astype(dtype)
+    limits = psNormalize.skycellLimits(imgData)
+
+    ref = psNormalize.normalizeSkycell(imgData.copy(), 'toasty', limits=limits)
+    fused = psNormalize.normalizeSkycell(imgData.copy(), 'fused', limits=limits)
+
+    assert fused.dtype == ref.dtype
+    assert np.abs(fused - ref).max() <= tolerance
+    # the tiles are made by casting to uint8
+    assert np.count_nonzero(fused.astype(np.uint8) != ref.astype(np.uint8)) == 0
+
+
+def test_limits_match_percentiles(skycellImage):
+    imgData = skycellImage((600, 700))
+    imean = np.nanmean(imgData)
+    vmax = (np.percentile(imgData[imgData >= imean], 99.5) + 4.3) / 2
+    vmin = (np.percentile(imgData[imgData <= imean], 0.5) - 1.3) / 2
+    assert psNormalize.skycellLimits(imgData) == (vmin, vmax)
+
+
+@pytest.mark.parametrize('subsample', [1, 4])
+def test_limits_of_nan_image(subsample):
+    imgData = np.full((300, 400), np.nan, dtype=np.float32)
+    # only every 4th pixel is valid, none of which are sampled with subsample 4
+    if subsample > 1:
+        imgData.reshape(-1)[1::4] = 1
+    with pytest.raises(ValueError):
+        psNormalize.skycellLimits(imgData, subsample)
@@ -0,0 +1,61 @@
+"""Tests of psTOAST's fitsCache: prefetching images in background threads must give the same images as reading them serially."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('toasty')
+
+import psTOAST
+from psNormalize import statsCatalog
+
+
+@pytest.fixture
+def skycellFiles(skycellImage, skycellFile):
+    return [skycellFile('skycell%d.fits' % seed, skycellImage((300, 320), seed)) for seed in range(6)]
+
+
+def test_prefetch_with_stats_matches_serial(tmp_path, skycellFiles):
+    serial = psTOAST.fitsCache(2**30)
+    expected = [serial.get(filename) for filename in skycellFiles]
+
+    stats = statsCatalog(str(tmp_path / 'stats.db'))
+    # the first run stores the limits from the prefetch threads, the second takes them from the catalog
+    for run in range(2):
+        cache = psTOAST.fitsCache(2**30, stats=stats, prefetchThreads=2)
+        cache.prefetch(skycellFiles)
+        for filename, ref in zip(skycellFiles, expected):
+            imgData = cache.get(filename)
+            assert imgData is not None
+            assert np.array_equal(imgData, ref)
+        assert cache.stats()['prefetchHits'] + cache.stats()['hits'] == len(skycellFiles)
+        cache.setPrefetch(0)
+
+    for filename in skycellFiles:
+        assert stats.get(filename) is not None
+
+
+def test_unreadable_file_is_null(tmp_path):
+    cache = psTOAST.fitsCache(2**30)
+    assert cache.get(str(tmp_path / 'missing.fits')) is None
+
+
+def test_nan_skycell_is_null(skycellFile):
+    # skycells at the edge of the survey can have no valid pixels
+    filename = skycellFile('nan.fits', np.full((300, 320), np.nan, dtype=np.float32))
+    cache = psTOAST.fitsCache(2**30)
+    assert cache.get(filename) is None
+
+
+@pytest.mark.parametrize('dtype', psTOAST.cacheDtypes)
+def test_cache_dtypes(skycellFiles, dtype):
+    ref = psTOAST.fitsCache(2**30).get(skycellFiles[0])
+    imgData = psTOAST.fitsCache(2**30, dtype=dtype).get(skycellFiles[0])
+    assert imgData.dtype == dtype
+    # float16 is not exact, the other types give the same (uint8 cast) tiles
+    if dtype != 'float16':
+        assert np.array_equal(imgData.astype(np.uint8), ref.astype(np.uint8))
+
+
+def test_unsupported_cache_dtype():
+    with pytest.raises(ValueError):
+        psTOAST.fitsCache(2**30, dtype='int8')